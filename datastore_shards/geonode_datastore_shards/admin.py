@@ -24,7 +24,8 @@ from .models import Database
 
 
 class DatabaseAdmin(admin.ModelAdmin):
-    list_display = ('name', 'strategy_type', 'layers_count', 'created_at', )
+    list_display = ('name', 'strategy_type', 'state', 'layers_count', 'size_bytes', 'rows_count', 'created_at', )
+    list_filter = ('state', )
 
 
 admin.site.register(Database, DatabaseAdmin)
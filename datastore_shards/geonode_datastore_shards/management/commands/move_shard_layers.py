@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 OSGeo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+from __future__ import print_function
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+
+    help = "Move the PostGIS tables of layers to another shard"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'layers',
+            nargs='*',
+            help="Names of the layers to move"
+        )
+        parser.add_argument(
+            '--source',
+            help="Move all the layers of this shard"
+        )
+        parser.add_argument(
+            '--target',
+            required=True,
+            help="Name of the shard receiving the layers"
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help="Number of layers moved in parallel (4 by default)"
+        )
+        parser.add_argument(
+            '--keep-source',
+            action='store_true',
+            default=False,
+            help="Do not drop the tables from the source shards"
+        )
+
+    def handle(self, *args, **kwargs):
+        from geonode.layers.models import Layer
+        from ...models import Database
+        from ...utils import move_layers_to_shard
+        if not kwargs.get('layers') and not kwargs.get('source'):
+            raise CommandError("Give the names of the layers or a --source shard")
+        target = kwargs['target']
+        if not Database.objects.filter(name=target, state=Database.READY).exists():
+            raise CommandError("%s is not a ready PostGIS database shard" % target)
+        layers = Layer.objects.exclude(store=target)
+        if kwargs.get('layers'):
+            layers = layers.filter(name__in=kwargs['layers'])
+        if kwargs.get('source'):
+            layers = layers.filter(store=kwargs['source'])
+        results = move_layers_to_shard(
+            list(layers), target, workers=kwargs['workers'], drop_source=not kwargs['keep_source'])
+        failed = 0
+        for layer, error in results:
+            if error is None:
+                self.stdout.write("%s moved to %s" % (layer.name, target))
+            else:
+                failed += 1
+                self.stderr.write("%s not moved: %s" % (layer.name, error))
+        if failed:
+            raise CommandError("%s of %s layers not moved" % (failed, len(results)))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datastore_shards', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='database',
+            name='size_bytes',
+            field=models.BigIntegerField(default=0, verbose_name='Size (bytes)'),
+        ),
+        migrations.AddField(
+            model_name='database',
+            name='rows_count',
+            field=models.BigIntegerField(default=0, verbose_name='Rows Count'),
+        ),
+        migrations.AddField(
+            model_name='database',
+            name='stats_updated_at',
+            field=models.DateTimeField(null=True, blank=True, verbose_name='Statistics Updated At'),
+        ),
+        migrations.AlterField(
+            model_name='database',
+            name='strategy_type',
+            field=models.IntegerField(choices=[(0, b'yearly'), (1, b'monthly'), (2, b'layercount'), (3, b'size'), (4, b'rows')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datastore_shards', '0002_database_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='database',
+            name='state',
+            field=models.IntegerField(choices=[(0, b'provisioning'), (1, b'ready'), (2, b'draining'), (3, b'dropped')], default=1, verbose_name='State'),
+        ),
+    ]
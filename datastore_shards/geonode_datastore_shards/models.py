@@ -21,6 +21,7 @@
 from geonode.layers.models import Layer
 
 from django.db import models
+from django.db.models import F
 from django.db.models import signals
 from django.utils.translation import ugettext_lazy as _
 
@@ -32,32 +33,89 @@ class Database(models.Model):
     YEARLY = 0
     MONTHLY = 1
     LAYERCOUNT = 2
+    SIZE = 3
+    ROWS = 4
     SHARD_STRATEGY_TYPE = (
         (YEARLY, 'yearly'),
         (MONTHLY, 'monthly'),
         (LAYERCOUNT, 'layercount'),
+        (SIZE, 'size'),
+        (ROWS, 'rows'),
     )
+    PROVISIONING = 0
+    READY = 1
+    DRAINING = 2
+    DROPPED = 3
+    STATE_TYPE = (
+        (PROVISIONING, 'provisioning'),
+        (READY, 'ready'),
+        (DRAINING, 'draining'),
+        (DROPPED, 'dropped'),
+    )
+    # Allowed state changes: new layers go to ready shards only, a dropped shard is kept as a tombstone
+    STATE_TRANSITIONS = {
+        PROVISIONING: (READY, DRAINING),
+        READY: (DRAINING, ),
+        DRAINING: (READY, DROPPED),
+        DROPPED: (),
+    }
 
     name = models.TextField(_("Database Shard Name"))
     layers_count = models.IntegerField(_("Layers Count"), default=0)
     created_at = models.DateTimeField(auto_now=True)
     strategy_type = models.IntegerField(choices=SHARD_STRATEGY_TYPE)
+    size_bytes = models.BigIntegerField(_("Size (bytes)"), default=0)
+    rows_count = models.BigIntegerField(_("Rows Count"), default=0)
+    stats_updated_at = models.DateTimeField(_("Statistics Updated At"), null=True, blank=True)
+    state = models.IntegerField(_("State"), choices=STATE_TYPE, default=READY)
 
     class Meta:
         verbose_name_plural = 'Shard Databases'
 
 
+def remember_layer_store(instance, **kwargs):
+    """
+    Remember the store of a loaded layer, to detect a store change when it is saved.
+    """
+    # a deferred store is not loaded: the previous store is unknown, and a save does not move the layer
+    if 'store' in instance.__dict__:
+        instance._shard_store = instance.__dict__['store']
+
+
+def add_shard_layers_count(store_name, delta):
+    """
+    Increment layers_count for Database model (a no-op when the store is not a shard).
+    """
+    if not store_name:
+        return
+    if Database.objects.filter(name=store_name).update(layers_count=F('layers_count') + delta):
+        # keep the live count used by the shard allocator up to date
+        from .utils import shard_allocator
+        shard_allocator.add_layers_count(store_name, delta)
+
+
 def update_shard_layers_count(instance, sender, **kwargs):
     """
-    Update layers_count for Database model.
+    Update layers_count for Database model when a layer is created, deleted or moved to another store.
+    Metadata-only saves do not touch the shards.
     """
     store_name = instance.store
-    # if layer is part of a shards we need to increment layers_count
-    if Database.objects.filter(name=store_name).exists():
-        shardatabase = Database.objects.get(name=store_name)
-        shardatabase.layers_count = Layer.objects.filter(store=store_name).count()
-        shardatabase.save()
+    if kwargs.get('signal') is signals.post_delete:
+        add_shard_layers_count(store_name, -1)
+        return
+    if kwargs.get('created'):
+        add_shard_layers_count(store_name, 1)
+    else:
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'store' not in update_fields:
+            return
+        previous_store = getattr(instance, '_shard_store', store_name)
+        if previous_store != store_name:
+            add_shard_layers_count(previous_store, -1)
+            add_shard_layers_count(store_name, 1)
+    instance._shard_store = store_name
 
 
+signals.post_init.connect(remember_layer_store, sender=Layer)
 signals.post_delete.connect(update_shard_layers_count, sender=Layer)
 signals.post_save.connect(update_shard_layers_count, sender=Layer)
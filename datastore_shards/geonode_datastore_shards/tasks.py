@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 OSGeo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+from celery import shared_task
+
+from . import utils
+from .models import Database
+
+
+@shared_task(bind=True, max_retries=5, default_retry_delay=30)
+def create_shard(self, db_name, shard_strategy):
+    """
+    Provision a shard, a failed provisioning is retried and finally discarded.
+    """
+    try:
+        utils.create_postgis_shard(db_name, shard_strategy)
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            utils.discard_postgis_shard(db_name)
+            raise
+        raise self.retry(exc=e)
+
+
+@shared_task(bind=True, max_retries=5, default_retry_delay=30)
+def drop_shard(self, db_name):
+    """
+    Drain and drop a shard.
+    """
+    try:
+        utils.drop_postgis_shard(db_name)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise self.retry(exc=e)
+
+
+@shared_task
+def vacuum_shard(db_name):
+    """
+    Vacuum and analyze a ready shard.
+    """
+    utils.run_shard_maintenance(db_name, 'VACUUM ANALYZE;')
+
+
+@shared_task
+def analyze_shard(db_name):
+    """
+    Analyze a ready shard.
+    """
+    utils.run_shard_maintenance(db_name, 'ANALYZE;')
+
+
+@shared_task
+def provision_shards():
+    """
+    Queue again the provisioning of the shards which are not ready yet (the provisioning is idempotent).
+    """
+    for db_name, shard_strategy in Database.objects.filter(
+            state=Database.PROVISIONING).values_list('name', 'strategy_type'):
+        create_shard.delay(db_name, shard_strategy)
+
+
+@shared_task
+def reconcile_shards_layers_count():
+    """
+    Fix the drift of the layers count of the shards.
+    """
+    utils.reconcile_layers_count()
+
+
+@shared_task
+def update_shards_stats():
+    """
+    Measure the load of the shards of the "size" and "rows" strategies, used by the shard allocator.
+    """
+    utils.update_shard_stats()
@@ -19,17 +19,31 @@
 #########################################################################
 
 
+import os
+import uuid
 import datetime
 import logging
-from psycopg2 import connect
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import psycopg2
+from psycopg2.extensions import quote_ident
+from psycopg2.pool import ThreadedConnectionPool
 import dj_database_url
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection as django_connection
+from django.db.models import Count
+from django.utils import timezone
 
 from geonode.layers.models import Layer
 
-from .models import Database
+from .models import Database, add_shard_layers_count
 
 
 logger = logging.getLogger(__name__)
@@ -40,97 +54,1045 @@ def get_today():
     return datetime.date.today()
 
 
+class ShardAllocator(object):
+    """
+    Allocate the shard of the uploads without querying the shards metadata in the common case.
+    The current "layercount" shard and the live layers count of the shards are kept in memory and
+    shared through the Django cache (by the processes using a memcached or redis backend), the
+    shards already created are remembered in memory.
+    Picking the shard has no side effects: the count of a shard is incremented (atomically, in the
+    cache) when a layer is created in it, and it is set again from its layers by
+    reconcile_layers_count.
+    """
+    CURRENT_KEY = 'datastore_shards:layercount:current'
+    COUNT_KEY = 'datastore_shards:layers_count:%s'
+    ROLLOVER_KEY = 'datastore_shards:layercount:rollover:%s'
+    DRAINED_KEY = 'datastore_shards:drained:%s'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._created = set()
+        self._current = None
+        self._counts = {}
+
+    def get_database_name(self, shard_prefix, shard_suffix, shard_layer_count):
+        """
+        Return the name of the current "layercount" shard, rolling over to a new one when full.
+        """
+        code = cache.get(self.CURRENT_KEY)
+        if code is None:
+            code = self._current
+        if code is None:
+            code = self._load_current()
+        db_name = '%s%05d%s' % (shard_prefix, code, shard_suffix)
+        if self.get_layers_count(db_name) >= shard_layer_count:
+            next_code, rolled_over = self._roll_over(code)
+            next_db_name = '%s%05d%s' % (shard_prefix, next_code, shard_suffix)
+            if rolled_over:
+                self.create_shard(next_db_name, Database.LAYERCOUNT)
+                self.set_layers_count(next_db_name, 0)
+                cache.set(self.CURRENT_KEY, next_code, None)
+                code, db_name = next_code, next_db_name
+            elif cache.get(self.CURRENT_KEY) == next_code:
+                code, db_name = next_code, next_db_name
+            # otherwise the rollover is still running: the full shard takes this layer too
+        ready = self.create_shard(db_name, Database.LAYERCOUNT)
+        with self._lock:
+            self._current = code
+        if not ready:
+            # the previous shard takes some more layers while the new one is provisioned
+            return get_ready_database_name(Database.LAYERCOUNT)
+        return db_name
+
+    def get_balanced_database_name(self, shard_strategy, shard_prefix, shard_suffix, max_load):
+        """
+        Return the least-loaded shard ("size" or "rows" strategy) under the max_load cap,
+        a new shard is created when all of them are full.
+        The statistics stored by the update_shards_stats task are used, the shards are not measured.
+        """
+        load_field = 'size_bytes' if shard_strategy == Database.SIZE else 'rows_count'
+        shards = list(Database.objects.filter(strategy_type=shard_strategy).order_by('id'))
+        # the codes of the dropped shards are not reused
+        count = len(shards)
+        shards = [shard for shard in shards if shard.state == Database.READY]
+        candidates = [shard for shard in shards if getattr(shard, load_field) < max_load]
+        if candidates:
+            db_name = min(candidates, key=lambda shard: (getattr(shard, load_field), shard.id)).name
+        else:
+            provisioning = Database.objects.filter(
+                strategy_type=shard_strategy, state=Database.PROVISIONING).values_list('name', flat=True).first()
+            db_name = provisioning or '%s%05d%s' % (shard_prefix, count, shard_suffix)
+            if not self.create_shard(db_name, shard_strategy):
+                # the least-loaded shard takes some more data while the new one is provisioned
+                if shards:
+                    return min(shards, key=lambda shard: (getattr(shard, load_field), shard.id)).name
+                return get_default_database_name()
+        return db_name
+
+    def create_shard(self, db_name, shard_strategy):
+        """
+        Request the shard, which is provisioned in background by the create_shard task.
+        The ready shards are remembered by this process.
+        :return: whether the shard is ready
+        """
+        if db_name in self._created and not cache.get(self.DRAINED_KEY % db_name):
+            return True
+        if not request_shard(db_name, shard_strategy):
+            return False
+        with self._lock:
+            self._created.add(db_name)
+        return True
+
+    def get_layers_count(self, db_name):
+        """
+        Return the layers count of a shard: the shared count in the cache, the count of this process
+        when the cache does not store it (e.g. DummyCache), loaded from the layers otherwise.
+        """
+        count = cache.get(self.COUNT_KEY % db_name)
+        if count is None:
+            count = self._counts.get(db_name)
+        if count is None:
+            count = Layer.objects.filter(store=db_name).count()
+            cache.add(self.COUNT_KEY % db_name, count, None)
+        with self._lock:
+            self._counts[db_name] = count
+        return count
+
+    def set_layers_count(self, db_name, count):
+        """
+        Store the layers count of a shard.
+        """
+        cache.set(self.COUNT_KEY % db_name, count, None)
+        with self._lock:
+            self._counts[db_name] = count
+
+    def add_layers_count(self, db_name, delta):
+        """
+        Increment the layers count of a shard (called when its layers change, a count unknown to
+        both the cache and this process is loaded again when needed).
+        """
+        try:
+            count = cache.incr(self.COUNT_KEY % db_name, delta)
+        except ValueError:
+            with self._lock:
+                if db_name in self._counts:
+                    self._counts[db_name] += delta
+            return
+        with self._lock:
+            self._counts[db_name] = count
+
+    def forget(self, db_name):
+        """
+        Forget a drained shard (in all the processes sharing the cache).
+        """
+        cache.delete(self.COUNT_KEY % db_name)
+        cache.set(self.DRAINED_KEY % db_name, True, None)
+        with self._lock:
+            self._created.discard(db_name)
+            self._counts.pop(db_name, None)
+
+    def _load_current(self):
+        """
+        Retrieve the current "layercount" shard from the database (once per process).
+        """
+        count = Database.objects.filter(strategy_type=Database.LAYERCOUNT).count()
+        code = count - 1 if count > 0 else 0
+        cache.add(self.CURRENT_KEY, code, None)
+        return code
+
+    def _roll_over(self, code):
+        """
+        Move from the full shard to the next one. The rollover key is added atomically (compare and
+        increment): only the first process moving from this shard creates the next one, the others
+        do not wait for it.
+        Returns the next shard code and whether this process has to create the shard.
+        """
+        next_code = code + 1
+        return next_code, cache.add(self.ROLLOVER_KEY % code, next_code, None)
+
+
+shard_allocator = ShardAllocator()
+
+
 def get_shard_database_name():
     """
-    Return the current PostGIS shard database name. It creates the database if it does not exist.
+    Return the current PostGIS shard database name. A missing shard is provisioned in background,
+    the last ready shard (or the default datastore database) is used in the meanwhile.
     """
     shard_strategy = getattr(settings, 'SHARD_STRATEGY', 'monthly')
-    if shard_strategy not in ('monthly', 'yearly', 'layercount'):
-        raise ValueError('SHARD_STRATEGY must be set to "monthly", "yearly" or "layercount"')
+    if shard_strategy not in ('monthly', 'yearly', 'layercount', 'size', 'rows'):
+        raise ValueError('SHARD_STRATEGY must be set to "monthly", "yearly", "layercount", "size" or "rows"')
     shard_prefix = getattr(settings, 'SHARD_PREFIX', '')
     shard_suffix = getattr(settings, 'SHARD_SUFFIX', '')
     shard_layer_count = getattr(settings, 'SHARD_LAYER_COUNT', 100)
     if shard_strategy == 'monthly':
         db_name = '%s%s%s' % (shard_prefix, get_today().strftime('%Y%m'), shard_suffix)
-        create_postgis_shard(db_name, Database.MONTHLY)
+        if not shard_allocator.create_shard(db_name, Database.MONTHLY):
+            db_name = get_ready_database_name(Database.MONTHLY)
     if shard_strategy == 'yearly':
         db_name = '%s%s%s' % (shard_prefix, get_today().strftime('%Y'), shard_suffix)
-        create_postgis_shard(db_name, Database.YEARLY)
+        if not shard_allocator.create_shard(db_name, Database.YEARLY):
+            db_name = get_ready_database_name(Database.YEARLY)
     if shard_strategy == 'layercount':
-        shard_numeric_code = Database.objects.filter(strategy_type=Database.LAYERCOUNT).count()
-        if shard_numeric_code > 0:
-            # Do we really need a new shard?
-            last_store_name = Database.objects.filter(strategy_type=Database.LAYERCOUNT).order_by('-created_at')[0].name
-            if Layer.objects.filter(store=last_store_name).count() < shard_layer_count:
-                shard_numeric_code -= 1
-        db_name = '%s%05d%s' % (shard_prefix, shard_numeric_code, shard_suffix)
-        if Database.objects.filter(name=db_name).count() == 0:
-            create_postgis_shard(db_name, Database.LAYERCOUNT)
+        db_name = shard_allocator.get_database_name(shard_prefix, shard_suffix, shard_layer_count)
+    if shard_strategy == 'size':
+        db_name = shard_allocator.get_balanced_database_name(
+            Database.SIZE, shard_prefix, shard_suffix, getattr(settings, 'SHARD_MAX_SIZE', 10 * 1024 ** 3))
+    if shard_strategy == 'rows':
+        db_name = shard_allocator.get_balanced_database_name(
+            Database.ROWS, shard_prefix, shard_suffix, getattr(settings, 'SHARD_MAX_ROWS', 10000000))
     return db_name
 
 
-def create_postgis_shard(db_name, shard_strategy):
+def connect_shard(db_name):
     """
-    Create a PostGIS shard database by name.
+    Open a connection to a shard database.
     """
-    shardatabase, created = Database.objects.get_or_create(name=db_name, strategy_type=shard_strategy)
-    if created:
-        logger.debug("Creating a new PostGIS datatase: %s" % db_name)
+    datastore_db = dj_database_url.parse(settings.DATASTORE_URL)
+    return psycopg2.connect(
+        dbname=db_name,
+        user=datastore_db['USER'],
+        host=datastore_db['HOST'],
+        port=datastore_db['PORT'],
+        password=datastore_db['PASSWORD'])
+
+
+def get_default_database_name():
+    """
+    Return the name of the default datastore database.
+    """
+    return dj_database_url.parse(settings.DATASTORE_URL)['NAME']
+
+
+def get_ready_database_name(shard_strategy):
+    """
+    Return the last ready shard of a strategy, or the default datastore database.
+    """
+    db_name = Database.objects.filter(
+        strategy_type=shard_strategy, state=Database.READY
+    ).order_by('-id').values_list('name', flat=True).first()
+    return db_name or get_default_database_name()
+
+
+def get_shard_rows_count(db_name):
+    """
+    Return the estimated number of rows of the tables of a shard.
+    """
+    with shard_router.connection(db_name) as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT COALESCE(SUM(n_live_tup), 0) FROM pg_stat_user_tables;')
+        rows_count = cur.fetchone()[0]
+        cur.close()
+    return int(rows_count)
+
+
+def update_shard_stats(shards=None):
+    """
+    Measure the load of the ready "size" and "rows" shards and store it on the Database model:
+    only the metric used by the strategy of each shard is measured.
+    """
+    if shards is None:
+        shards = list(Database.objects.filter(
+            state=Database.READY, strategy_type__in=(Database.SIZE, Database.ROWS)))
+    sized = [shard.name for shard in shards if shard.strategy_type == Database.SIZE]
+    sizes = {}
+    if sized:
+        sizes = dict(admin_connections.execute(
+            'SELECT datname, pg_database_size(datname) FROM pg_database WHERE datname = ANY(%s);', (sized, )
+        ))
+    now = timezone.now()
+    for shard in shards:
+        if shard.strategy_type == Database.SIZE:
+            if shard.name not in sizes:
+                continue
+            shard.size_bytes = sizes[shard.name]
+            stats = {'size_bytes': shard.size_bytes}
+        elif shard.strategy_type == Database.ROWS:
+            try:
+                shard.rows_count = get_shard_rows_count(shard.name)
+            except Exception as e:
+                logger.error("Error counting the rows of PostGIS database shard %s: %s" % (shard.name, str(e)))
+                continue
+            stats = {'rows_count': shard.rows_count}
+        else:
+            continue
+        shard.stats_updated_at = now
+        # update() does not touch created_at (auto_now)
+        Database.objects.filter(pk=shard.pk).update(stats_updated_at=now, **stats)
+
+
+class BoundedConnectionPool(ThreadedConnectionPool):
+    """
+    Thread-safe pool of up to maxconn connections, opened when needed and kept open when returned.
+    ThreadedConnectionPool raises PoolError when all its connections are in use: here the threads
+    wait for a connection to be returned instead.
+    """
+
+    def __init__(self, maxconn, *args, **kwargs):
+        super(BoundedConnectionPool, self).__init__(0, maxconn, *args, **kwargs)
+        # the returned connections are kept up to minconn: no connections are opened in advance
+        self.minconn = maxconn
+        self._semaphore = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        self._semaphore.acquire()
+        try:
+            return super(BoundedConnectionPool, self).getconn(key)
+        except Exception:
+            self._semaphore.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super(BoundedConnectionPool, self).putconn(conn, key, close)
+        finally:
+            self._semaphore.release()
+
+
+class ShardAdminConnections(object):
+    """
+    Small pool of autocommit connections to the maintenance database of the datastore
+    (postgres), used to create, rename and drop the shards. Connections to template1 would
+    prevent other sessions from creating databases with the default template.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    @contextmanager
+    def connection(self):
+        """
+        Yield a pooled autocommit connection, broken connections are discarded.
+        """
+        pool = self._get_pool()
+        conn = pool.getconn()
+        broken = False
         try:
-            datastore_db = dj_database_url.parse(settings.DATASTORE_URL)
-            user = datastore_db['USER']
-            host = datastore_db['HOST']
-            port = datastore_db['PORT']
-            password = datastore_db['PASSWORD']
-            # 1. create the database
-            conn = connect(dbname='template1', user=user, host=host, port=port, password=password)
-            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.autocommit = True
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            pool.putconn(conn, close=broken or bool(conn.closed))
+
+    def connect(self):
+        """
+        Open an autocommit connection outside the pool, which does not hold a pooled connection
+        while the pool is used (e.g. for a session-level advisory lock).
+        """
+        datastore_db = dj_database_url.parse(settings.DATASTORE_URL)
+        conn = psycopg2.connect(
+            dbname='postgres',
+            user=datastore_db['USER'],
+            host=datastore_db['HOST'],
+            port=datastore_db['PORT'],
+            password=datastore_db['PASSWORD'])
+        conn.autocommit = True
+        return conn
+
+    def execute(self, sql, params=None):
+        """
+        Execute a statement on a pooled connection and return the fetched rows (if any).
+        """
+        with self.connection() as conn:
             cur = conn.cursor()
-            cur.execute('CREATE DATABASE %s;' % db_name)
-            cur.close()
-            conn.close()
-            # 2. enable PostGIS
-            conn = connect(dbname=db_name, user=user, host=host, port=port, password=password)
+            try:
+                cur.execute(sql, params)
+                return cur.fetchall() if cur.description else None
+            finally:
+                cur.close()
+
+    def close_all(self):
+        """
+        Close all the pooled connections.
+        """
+        with self._lock:
+            for pool in self._pools.values():
+                pool.closeall()
+            self._pools = {}
+
+    def _get_pool(self):
+        with self._lock:
+            pool = self._pools.get(settings.DATASTORE_URL)
+            if pool is None:
+                datastore_db = dj_database_url.parse(settings.DATASTORE_URL)
+                pool = BoundedConnectionPool(
+                    getattr(settings, 'SHARD_ADMIN_POOL_SIZE', 4),
+                    dbname='postgres',
+                    user=datastore_db['USER'],
+                    host=datastore_db['HOST'],
+                    port=datastore_db['PORT'],
+                    password=datastore_db['PASSWORD'])
+                self._pools[settings.DATASTORE_URL] = pool
+            return pool
+
+
+admin_connections = ShardAdminConnections()
+
+
+class ShardRouter(object):
+    """
+    Route the reads of the layer tables to pooled connections to their shards, and run
+    queries on all the shards concurrently.
+    """
+    # Rows fetched at a time by the fan-out queries
+    FETCH_SIZE = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._databases = {}
+
+    def get_database_name(self, layer):
+        """
+        Return the database of a layer: its shard, or the default datastore database.
+        """
+        store_name = layer.store
+        db_name = self._databases.get(store_name)
+        if db_name is None:
+            if Database.objects.filter(name=store_name).exists():
+                db_name = store_name
+            else:
+                db_name = get_default_database_name()
+            with self._lock:
+                self._databases[store_name] = db_name
+        return db_name
+
+    @contextmanager
+    def connection(self, db_name):
+        """
+        Yield a pooled connection to a database, the transaction is committed (or rolled back
+        on errors) when the block ends. Broken connections are discarded.
+        """
+        pool = self._get_pool(db_name)
+        conn = pool.getconn()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn, close=broken or bool(conn.closed))
+
+    def connection_for(self, layer):
+        """
+        Yield a pooled connection to the database of a layer.
+        """
+        return self.connection(self.get_database_name(layer))
+
+    def fan_out(self, sql, params=None, shards=None):
+        """
+        Run a query on the shards concurrently (SHARD_FAN_OUT_WORKERS at a time).
+        :param shards: names of the shards (all of them by default)
+        :return: generator of (shard name, row) tuples, in arrival order
+        """
+        if shards is None:
+            shards = list(Database.objects.filter(
+                state__in=(Database.READY, Database.DRAINING)).order_by('id').values_list('name', flat=True))
+        if not shards:
+            return
+        results = queue.Queue(maxsize=getattr(settings, 'SHARD_FAN_OUT_BUFFER', 10))
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def run(db_name):
+            try:
+                with self.connection(db_name) as conn:
+                    # server-side cursor: the rows are streamed, not loaded at once
+                    cursor = conn.cursor(name='shard_fan_out')
+                    cursor.execute(sql, params)
+                    while not stop.is_set():
+                        rows = cursor.fetchmany(self.FETCH_SIZE)
+                        if not rows:
+                            break
+                        put((db_name, rows, None))
+                    cursor.close()
+            except Exception as e:
+                put((db_name, None, e))
+            put((db_name, None, None))
+
+        pool = ThreadPool(max(1, min(len(shards), getattr(settings, 'SHARD_FAN_OUT_WORKERS', 8))))
+        try:
+            for db_name in shards:
+                pool.apply_async(run, (db_name, ))
+            pending = len(shards)
+            while pending:
+                db_name, rows, error = results.get()
+                if error is not None:
+                    raise error
+                if rows is None:
+                    pending -= 1
+                    continue
+                for row in rows:
+                    yield db_name, row
+        finally:
+            stop.set()
+            pool.close()
+            pool.join()
+
+    def close(self, db_name):
+        """
+        Close the pooled connections of this process to a database (the sessions of the other
+        processes are terminated by drop_postgis_shard).
+        """
+        with self._lock:
+            pool = self._pools.pop((settings.DATASTORE_URL, db_name), None)
+            for store_name in [k for k, v in self._databases.items() if v == db_name]:
+                del self._databases[store_name]
+        if pool is not None:
+            pool.closeall()
+
+    def close_all(self):
+        """
+        Close all the pooled connections.
+        """
+        with self._lock:
+            for pool in self._pools.values():
+                pool.closeall()
+            self._pools = {}
+            self._databases = {}
+
+    def _get_pool(self, db_name):
+        key = (settings.DATASTORE_URL, db_name)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                datastore_db = dj_database_url.parse(settings.DATASTORE_URL)
+                pool = BoundedConnectionPool(
+                    getattr(settings, 'SHARD_POOL_SIZE', 4),
+                    dbname=db_name,
+                    user=datastore_db['USER'],
+                    host=datastore_db['HOST'],
+                    port=datastore_db['PORT'],
+                    password=datastore_db['PASSWORD'])
+                self._pools[key] = pool
+            return pool
+
+
+shard_router = ShardRouter()
+
+
+def get_template_database_name():
+    """
+    Return the name of the PostGIS-enabled template database of the shards.
+    """
+    return getattr(
+        settings, 'SHARD_TEMPLATE_DATABASE',
+        '%stemplate%s' % (getattr(settings, 'SHARD_PREFIX', ''), getattr(settings, 'SHARD_SUFFIX', ''))
+    )
+
+
+def create_template_database():
+    """
+    Create the PostGIS-enabled template database if it does not exist.
+    """
+    template_name = get_template_database_name()
+    if admin_connections.execute('SELECT 1 FROM pg_database WHERE datname = %s;', (template_name, )):
+        return template_name
+    logger.debug("Creating the PostGIS template database: %s" % template_name)
+    # template0 is never changed by the users of the cluster, unlike template1
+    admin_connections.execute('CREATE DATABASE %s TEMPLATE template0;' % template_name)
+    # the template must have no connections when it is copied: this one is not pooled
+    datastore_db = dj_database_url.parse(settings.DATASTORE_URL)
+    try:
+        conn = psycopg2.connect(
+            dbname=template_name,
+            user=datastore_db['USER'],
+            host=datastore_db['HOST'],
+            port=datastore_db['PORT'],
+            password=datastore_db['PASSWORD'])
+        try:
             cur = conn.cursor()
-            cur.execute('CREATE EXTENSION postgis;')
+            cur.execute('CREATE EXTENSION IF NOT EXISTS postgis;')
             cur.close()
             conn.commit()
+        finally:
             conn.close()
-        except Exception as e:
-            logger.error(
-                "Error creating PostGIS database shard %s: %s" % (db_name, str(e)))
+    except Exception:
+        # a template without PostGIS would be copied to the new shards: it is created again next time
+        admin_connections.execute('DROP DATABASE IF EXISTS %s;' % template_name)
+        raise
+    return template_name
+
+
+def create_database_from_template(db_name):
+    """
+    Create a PostGIS database copying the template database.
+    """
+    template_name = create_template_database()
+    admin_connections.execute('CREATE DATABASE %s TEMPLATE %s;' % (db_name, template_name))
+
+
+class ShardProvisioner(object):
+    """
+    Background pre-provisioner keeping SHARD_SPARE_COUNT spare databases created in advance,
+    so that a new shard is handed out by renaming a spare database instead of creating it
+    inside the upload request.
+    """
+    # pg_try_advisory_lock key, only one process at a time creates the spare databases
+    LOCK_KEY = 'datastore_shards_provisioner'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wake = threading.Event()
+
+    @property
+    def spare_count(self):
+        return getattr(settings, 'SHARD_SPARE_COUNT', 0)
+
+    @property
+    def spare_prefix(self):
+        return '%sspare_' % getattr(settings, 'SHARD_PREFIX', '')
+
+    def get_spares(self):
+        """
+        Return the names of the spare databases.
+        """
+        rows = admin_connections.execute(
+            'SELECT datname FROM pg_database WHERE substr(datname, 1, %s) = %s ORDER BY datname;',
+            (len(self.spare_prefix), self.spare_prefix)
+        )
+        return [row[0] for row in rows]
+
+    def take_spare(self, db_name):
+        """
+        Rename a spare database to db_name. Returns False when no spare database is available.
+        """
+        if not self.spare_count:
+            return False
+        taken = False
+        for spare in self.get_spares():
+            try:
+                admin_connections.execute('ALTER DATABASE %s RENAME TO %s;' % (spare, db_name))
+            except psycopg2.Error as e:
+                # taken by another process in the meanwhile
+                logger.debug("Spare database %s not available: %s" % (spare, str(e)))
+                continue
+            logger.debug("Spare database %s handed out as %s" % (spare, db_name))
+            taken = True
+            break
+        self.start()
+        return taken
+
+    def fill(self):
+        """
+        Create the missing spare databases.
+        The lock is held by a connection outside the admin pool, which the databases are created with.
+        """
+        conn = admin_connections.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT pg_try_advisory_lock(hashtext(%s));', (self.LOCK_KEY, ))
+            if not cur.fetchone()[0]:
+                return
+            try:
+                for _i in range(self.spare_count - len(self.get_spares())):
+                    spare = '%s%s%s' % (
+                        self.spare_prefix, uuid.uuid4().hex[:12], getattr(settings, 'SHARD_SUFFIX', ''))
+                    logger.debug("Creating the spare database: %s" % spare)
+                    create_database_from_template(spare)
+            finally:
+                cur.execute('SELECT pg_advisory_unlock(hashtext(%s));', (self.LOCK_KEY, ))
         finally:
+            # closing the session releases the lock too
+            conn.close()
+
+    def start(self):
+        """
+        Start the background thread (if needed) and wake it up.
+        """
+        if not self.spare_count:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ShardProvisioner')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(getattr(settings, 'SHARD_SPARE_CHECK_INTERVAL', 300))
+            self._wake.clear()
             try:
-                if conn:
-                    conn.close()
+                self.fill()
             except Exception as e:
-                logger.error("Error closing PostGIS conn %s", str(e))
+                logger.error("Error creating the spare PostGIS databases: %s" % str(e))
+
+
+shard_provisioner = ShardProvisioner()
+
+
+def set_shard_state(db_name, state):
+    """
+    Move a shard to another state (STATE_TRANSITIONS), atomically.
+    :return: False when the shard is missing or its state does not allow the change
+    """
+    from_states = [
+        from_state for from_state, to_states in Database.STATE_TRANSITIONS.items() if state in to_states
+    ]
+    return bool(Database.objects.filter(name=db_name, state__in=from_states).update(state=state))
+
+
+def database_exists(db_name):
+    """
+    Return whether a database exists in the datastore server.
+    """
+    return bool(admin_connections.execute('SELECT 1 FROM pg_database WHERE datname = %s;', (db_name, )))
+
+
+def request_shard(db_name, shard_strategy):
+    """
+    Register a shard and queue its provisioning (the create_shard task) when it is new.
+    :return: whether the shard is ready
+    """
+    shard, created = Database.objects.get_or_create(
+        name=db_name, defaults={'strategy_type': shard_strategy, 'state': Database.PROVISIONING})
+    if created:
+        from .tasks import create_shard
+        try:
+            create_shard.delay(db_name, shard_strategy)
+        except Exception as e:
+            logger.error(
+                "Error provisioning PostGIS database shard %s: %s" % (db_name, str(e)))
+        # the task runs in this process when Celery is eager
+        shard.refresh_from_db()
+    return shard.state == Database.READY
+
+
+def create_postgis_shard(db_name, shard_strategy):
+    """
+    Provision a PostGIS shard database by name, then mark it ready. It is idempotent: an existing
+    database is kept, so a failed provisioning can be retried.
+    :return: whether the shard is ready
+    """
+    shardatabase, created = Database.objects.get_or_create(
+        name=db_name, defaults={'strategy_type': shard_strategy, 'state': Database.PROVISIONING})
+    if shardatabase.state != Database.PROVISIONING:
+        return shardatabase.state == Database.READY
+    if not database_exists(db_name):
+        logger.debug("Creating a new PostGIS datatase: %s" % db_name)
+        if not shard_provisioner.take_spare(db_name):
+            create_database_from_template(db_name)
+    return set_shard_state(db_name, Database.READY)
+
+
+def discard_postgis_shard(db_name):
+    """
+    Remove the metadata of a shard whose provisioning failed (the shard is not left half created).
+    """
+    logger.error("Provisioning of PostGIS database shard %s failed" % db_name)
+    Database.objects.filter(name=db_name, state=Database.PROVISIONING).delete()
+    admin_connections.execute('DROP DATABASE IF EXISTS %s;' % db_name)
 
 
 def drop_postgis_shard(db_name):
     """
-    Drop a PostGIS shard database by name.
+    Drop a PostGIS shard database by name. The shard is drained first (no new layers go there), and
+    it is dropped only when its layers have been moved to other shards (move_shard_layers).
+    The dropped shard is kept as a tombstone. It is idempotent, errors are raised to be retried.
     """
-    Database.objects.filter(name=db_name).delete()
+    if not set_shard_state(db_name, Database.DRAINING):
+        if not Database.objects.filter(name=db_name, state__in=(Database.DRAINING, Database.DROPPED)).exists():
+            raise ValueError('%s is not a PostGIS database shard which can be dropped' % db_name)
+    # no process routes new layers to the draining shard, even while its layers are moved
+    shard_allocator.forget(db_name)
+    if Layer.objects.filter(store=db_name).exists():
+        raise ValueError('PostGIS database shard %s is draining, move its layers to another shard first' % db_name)
+    shard_router.close(db_name)
     logger.debug("Dropping PostGIS datatase shard: %s" % db_name)
+    # the connections pooled by the other processes (the database can not be dropped while connected)
+    admin_connections.execute(
+        'SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = %s AND pid <> pg_backend_pid();',
+        (db_name, ))
+    admin_connections.execute('DROP DATABASE IF EXISTS %s;' % db_name)
+    set_shard_state(db_name, Database.DROPPED)
+
+
+def run_shard_maintenance(db_name, statement):
+    """
+    Run a maintenance statement (VACUUM, ANALYZE) on a ready shard, outside a transaction.
+    :return: False when the shard is not ready
+    """
+    if not Database.objects.filter(name=db_name, state=Database.READY).exists():
+        return False
+    with shard_router.connection(db_name) as conn:
+        conn.autocommit = True
+        try:
+            cursor = conn.cursor()
+            cursor.execute(statement)
+            cursor.close()
+        finally:
+            conn.autocommit = False
+    return True
+
+
+def reconcile_layers_count():
+    """
+    Fix the drift of the layers_count of the shards (with one grouped count of the layers).
+    :return: names of the fixed shards
+    """
+    shards = dict(Database.objects.values_list('name', 'layers_count'))
+    counts = dict(
+        Layer.objects.filter(store__in=list(shards)).values_list('store').annotate(count=Count('id')).order_by()
+    )
+    fixed = []
+    for name, layers_count in shards.items():
+        count = counts.get(name, 0)
+        if count != layers_count:
+            logger.warning(
+                "Fixing the layers count of PostGIS database shard %s: %s -> %s" % (name, layers_count, count))
+            Database.objects.filter(name=name).update(layers_count=count)
+            fixed.append(name)
+        shard_allocator.set_layers_count(name, count)
+    return fixed
+
+
+def get_table_definition(cursor, table_name):
+    """
+    Read the definition of a shard table.
+    :return: (CREATE TABLE statement, constraints and indexes statements, serial columns)
+    """
+    table = quote_ident(table_name, cursor)
+    cursor.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod), a.attnotnull,
+               COALESCE(pg_get_expr(d.adbin, d.adrelid) LIKE 'nextval(%%', false)
+        FROM pg_attribute a
+        LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+        WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY a.attnum;""", (table, ))
+    columns = []
+    serial_columns = []
+    for name, column_type, not_null, serial in cursor.fetchall():
+        if serial and column_type in ('integer', 'bigint'):
+            column_type = 'serial' if column_type == 'integer' else 'bigserial'
+            serial_columns.append(name)
+        columns.append('%s %s%s' % (quote_ident(name, cursor), column_type, ' NOT NULL' if not_null else ''))
+    create_table = 'CREATE TABLE %s (%s);' % (table, ', '.join(columns))
+
+    # constraints first, their indexes are not created twice
+    cursor.execute("""
+        SELECT 'ALTER TABLE ' || %s || ' ADD CONSTRAINT ' || quote_ident(conname) || ' ' ||
+               pg_get_constraintdef(oid) || ';'
+        FROM pg_constraint WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'c')
+        UNION ALL
+        SELECT pg_get_indexdef(i.indexrelid) || ';'
+        FROM pg_index i
+        WHERE i.indrelid = %s::regclass
+        AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid);""", (table, table, table))
+    statements = [row[0] for row in cursor.fetchall()]
+    return create_table, statements, serial_columns
+
+
+def copy_table(source_conn, target_conn, table_name):
+    """
+    Stream the rows of a table between two shards (COPY TO STDOUT piped into COPY FROM STDIN).
+    """
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, 'rb')
+    writer = os.fdopen(write_fd, 'wb')
+    errors = []
+
+    def copy_out():
+        try:
+            cursor = source_conn.cursor()
+            cursor.copy_expert(
+                'COPY %s TO STDOUT (FORMAT binary);' % quote_ident(table_name, cursor), writer)
+            cursor.close()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            writer.close()
+
+    thread = threading.Thread(target=copy_out)
+    thread.daemon = True
+    thread.start()
     try:
+        cursor = target_conn.cursor()
+        cursor.copy_expert('COPY %s FROM STDIN (FORMAT binary);' % quote_ident(table_name, cursor), reader)
+        cursor.close()
+    finally:
+        reader.close()
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def get_or_create_shard_store(db_name, workspace):
+    """
+    Return the GeoServer PostGIS store of a shard, creating it when missing.
+    """
+    from geoserver.catalog import FailedRequestError
+    from geonode.geoserver.helpers import gs_catalog
+    try:
+        store = gs_catalog.get_store(db_name, workspace=workspace)
+    except FailedRequestError:
+        store = None
+    if store is None:
+        logger.debug("Creating the GeoServer store of PostGIS database shard %s" % db_name)
         datastore_db = dj_database_url.parse(settings.DATASTORE_URL)
-        user = datastore_db['USER']
-        host = datastore_db['HOST']
-        port = datastore_db['PORT']
-        password = datastore_db['PASSWORD']
-        conn = connect(dbname='template1', user=user, host=host, port=port, password=password)
-        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-        cur = conn.cursor()
-        cur.execute('DROP DATABASE %s;' % db_name)
-        cur.close()
-        conn.close()
-    except Exception as e:
-        logger.error(
-            "Error dropping PostGIS database shard %s: %s" % (db_name, str(e)))
+        store = gs_catalog.create_datastore(db_name, workspace=workspace)
+        store.connection_parameters.update({
+            'host': datastore_db['HOST'],
+            'port': str(datastore_db['PORT'] or '5432'),
+            'database': db_name,
+            'user': datastore_db['USER'],
+            'passwd': datastore_db['PASSWORD'],
+            'dbtype': 'postgis',
+            'schema': 'public',
+            'Expose primary keys': 'true',
+            'Estimated extends': 'true',
+            'Loose bbox': 'true',
+        })
+        gs_catalog.save(store)
+        store = gs_catalog.get_store(db_name, workspace=workspace)
+    return store
+
+
+def publish_geoserver_layer(layer, store, projection, title, abstract, default_style, styles):
+    """
+    Publish the GeoServer layer of a table from a store, with the given title, abstract and styles.
+    """
+    from geonode.geoserver.helpers import gs_catalog
+    resource = gs_catalog.publish_featuretype(layer.name, store, projection, srs=projection)
+    resource.title = title
+    resource.abstract = abstract
+    gs_catalog.save(resource)
+    gs_layer = gs_catalog.get_layer(layer.alternate)
+    gs_layer.default_style = default_style
+    gs_layer.styles = styles
+    gs_catalog.save(gs_layer)
+
+
+def rebind_geoserver_layer(layer, db_name):
+    """
+    Publish the GeoServer layer from the store of another shard, keeping title, abstract and styles.
+    The feature type names are unique in the workspace, so the layer is deleted before being published
+    again: when the new store cannot publish it, the layer is published again from its source store.
+    """
+    from geonode.geoserver.helpers import gs_catalog
+    store = get_or_create_shard_store(db_name, layer.workspace)
+    gs_layer = gs_catalog.get_layer(layer.alternate)
+    default_style = gs_layer.default_style
+    styles = gs_layer.styles
+    resource = gs_layer.resource
+    source_store = resource.store
+    published = (resource.projection, resource.title, resource.abstract, default_style, styles)
+    gs_catalog.delete(gs_layer)
+    gs_catalog.delete(resource)
+    try:
+        publish_geoserver_layer(layer, store, *published)
+    except Exception:
+        logger.error("Error publishing layer %s from shard %s, restoring it" % (layer.alternate, db_name))
+        gs_layer = gs_catalog.get_layer(layer.alternate)
+        if gs_layer is not None:
+            resource = gs_layer.resource
+            gs_catalog.delete(gs_layer)
+            gs_catalog.delete(resource)
+        publish_geoserver_layer(layer, source_store, *published)
+        raise
+
+
+def move_layer_to_shard(layer, db_name, drop_source=True):
+    """
+    Move the table of a layer to another shard, then bind the layer to the new shard
+    (GeoServer store and Layer.store).
+    :return: False when the layer is already in the shard
+    """
+    source_name = layer.store
+    if source_name == db_name:
+        return False
+    if not Database.objects.filter(name=db_name, state=Database.READY).exists():
+        raise ValueError('%s is not a ready PostGIS database shard' % db_name)
+    logger.debug("Moving layer %s from %s to %s" % (layer.name, source_name, db_name))
+    source_conn = connect_shard(source_name)
+    target_conn = connect_shard(db_name)
+    try:
+        # the snapshot makes the definition and the copied rows consistent, and the lock (taken
+        # before the snapshot) blocks the writes to the source table until the layer is rebound
+        source_conn.set_session(isolation_level='REPEATABLE READ')
+        cursor = source_conn.cursor()
+        cursor.execute('LOCK TABLE %s IN SHARE MODE;' % quote_ident(layer.name, cursor))
+        create_table, statements, serial_columns = get_table_definition(cursor, layer.name)
+        cursor.close()
+
+        cursor = target_conn.cursor()
+        cursor.execute(create_table)
+        copy_table(source_conn, target_conn, layer.name)
+        # constraints and indexes are built once, after the copy
+        for statement in statements:
+            cursor.execute(statement)
+        table = quote_ident(layer.name, cursor)
+        for column in serial_columns:
+            cursor.execute(
+                'SELECT setval(pg_get_serial_sequence(%%s, %%s), COALESCE(MAX(%s), 0) + 1, false) FROM %s;' % (
+                    quote_ident(column, cursor), table), (table, column))
+        cursor.execute('ANALYZE %s;' % table)
+        cursor.close()
+        target_conn.commit()
+
+        try:
+            rebind_geoserver_layer(layer, db_name)
+        except Exception:
+            # do not leave an orphan copy in the target shard
+            cursor = target_conn.cursor()
+            cursor.execute('DROP TABLE %s;' % table)
+            target_conn.commit()
+            raise
+        Layer.objects.filter(pk=layer.pk).update(store=db_name)
+        layer.store = db_name
+        layer._shard_store = db_name
+        add_shard_layers_count(source_name, -1)
+        add_shard_layers_count(db_name, 1)
+
+        if drop_source:
+            cursor = source_conn.cursor()
+            cursor.execute('DROP TABLE %s;' % table)
+            cursor.close()
+            source_conn.commit()
+        else:
+            # releases the lock
+            source_conn.rollback()
     finally:
+        source_conn.close()
+        target_conn.close()
+    return True
+
+
+def move_layers_to_shard(layers, db_name, workers=4, drop_source=True):
+    """
+    Move the tables of several layers to another shard, in parallel.
+    :return: list of (layer, error) tuples, error is None when the layer has been moved
+    """
+    def move(layer):
         try:
-            if conn:
-                conn.close()
+            move_layer_to_shard(layer, db_name, drop_source)
+            return layer, None
         except Exception as e:
-            logger.error("Error closing PostGIS conn %s", str(e))
+            logger.error("Error moving layer %s to PostGIS database shard %s: %s" % (layer.name, db_name, str(e)))
+            return layer, e
+        finally:
+            # the Django connections are per thread
+            django_connection.close()
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        return pool.map(move, layers)
+    finally:
+        pool.close()
+        pool.join()
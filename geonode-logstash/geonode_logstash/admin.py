@@ -18,6 +18,7 @@
 #
 #########################################################################
 
+from django.conf import settings
 from django.contrib import admin
 from django.contrib import messages
 from django.http import HttpResponseRedirect
@@ -25,7 +26,6 @@ from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_protect
 
 from geonode_logstash.models import CentralizedServer
-from geonode_logstash.logstash import LogstashDispatcher
 
 csrf_protect_m = method_decorator(csrf_protect)
 
@@ -38,7 +38,8 @@ class CentralizedServerAdmin(admin.ModelAdmin):
     )
     list_filter = ('host', )
     readonly_fields = [
-        'last_successful_deliver', 'next_scheduled_deliver', 'last_failed_deliver'
+        'last_successful_deliver', 'next_scheduled_deliver', 'last_failed_deliver',
+        'last_queued_deliver', 'spool_cursor'
     ]
     change_form_template = "admin/centralized_server_change_form.html"
 
@@ -46,6 +47,8 @@ class CentralizedServerAdmin(admin.ModelAdmin):
     port = None
 
     def _test_connection(self, host, port):
+        # The dispatcher (and its dependencies) is loaded on demand to keep the admin startup light
+        from geonode_logstash.logstash import LogstashDispatcher
         ld = LogstashDispatcher()
         ld.test_dispatch(host, port)
 
@@ -81,9 +84,9 @@ class CentralizedServerAdmin(admin.ModelAdmin):
         )
 
     def has_add_permission(self, request):
-        # Avoid adding more than one record
+        # Avoid adding more than one record (unless the metrics are spooled for several servers)
         base_add_permission = super(CentralizedServerAdmin, self).has_add_permission(request)
-        if base_add_permission:
+        if base_add_permission and not getattr(settings, 'USER_ANALYTICS_SPOOL_DISPATCH', False):
             if CentralizedServer.objects.count():
                 return False
         return True
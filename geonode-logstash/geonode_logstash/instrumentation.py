@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2019 OSGeo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+
+# Timed stages of the dispatch
+STAGES = (
+    ("query", "Metric queries (CollectorAPI, grouped and extra fields queries)"),
+    ("build", "Message build, queries excluded"),
+    ("serialize", "JSON serialization of a message"),
+    ("compress", "Compression of a serialized message"),
+    ("enqueue", "Handler emit of a message (serialization and compression included)"),
+    ("send", "Socket send of a batch of events"),
+    ("flush", "SQLite read and delete of the cached events"),
+)
+
+STAGE_HISTOGRAM = "geonode_logstash_stage_duration_seconds"
+
+COUNTERS = (
+    ("geonode_logstash_messages_total", "Messages built"),
+    ("geonode_logstash_bytes_total", "Bytes produced by the serialize and compress stages"),
+    ("geonode_logstash_events_sent_total", "Events sent to the Logstash servers"),
+)
+
+
+class StageTimer(object):
+    """
+    Elapsed time of a timed block
+    """
+
+    def __init__(self):
+        self.elapsed = 0.0
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of the observed durations
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last count is the "+Inf" bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Add an observation
+        :param value: duration in seconds
+        :return: None
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class DispatchInstrumentation(object):
+    """
+    Prometheus-style registry of the dispatch timings and counters
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def reset(self):
+        """
+        Clear all the observations
+        :return: None
+        """
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+
+    @contextmanager
+    def time(self, stage):
+        """
+        Time the execution of a block of code
+        :param stage: name of the stage
+        :return: StageTimer (its elapsed time is set when the block ends)
+        """
+        timer = StageTimer()
+        start = time.perf_counter()
+        try:
+            yield timer
+        finally:
+            timer.elapsed = time.perf_counter() - start
+            self.observe(stage, timer.elapsed)
+
+    def observe(self, stage, seconds):
+        """
+        Add the duration of a stage
+        :param stage: name of the stage
+        :param seconds: duration in seconds
+        :return: None
+        """
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram(self._buckets)
+            histogram.observe(seconds)
+
+    def inc(self, name, value=1, stage=None):
+        """
+        Increment a counter
+        :param name: name of the counter
+        :param value: increment
+        :param stage: optional "stage" label
+        :return: None
+        """
+        with self._lock:
+            self._counters[(name, stage)] = self._counters.get((name, stage), 0) + value
+
+    def get_histogram(self, stage):
+        """
+        Get count and sum of the durations of a stage
+        :param stage: name of the stage
+        :return: (count, sum) tuple
+        """
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            return (histogram.count, histogram.sum) if histogram else (0, 0.0)
+
+    def get_counter(self, name, stage=None):
+        """
+        Get the value of a counter
+        :param name: name of the counter
+        :param stage: optional "stage" label
+        :return: counter value
+        """
+        with self._lock:
+            return self._counters.get((name, stage), 0)
+
+    def render(self):
+        """
+        Export the observations in the Prometheus text format
+        :return: text
+        """
+        lines = []
+        with self._lock:
+            lines.append("# HELP {} Duration of the dispatch stages.".format(STAGE_HISTOGRAM))
+            lines.append("# TYPE {} histogram".format(STAGE_HISTOGRAM))
+            for stage, _description in STAGES:
+                histogram = self._histograms.get(stage)
+                if histogram is None:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(
+                        STAGE_HISTOGRAM, stage, bound, cumulative))
+                lines.append('{}_sum{{stage="{}"}} {}'.format(STAGE_HISTOGRAM, stage, histogram.sum))
+                lines.append('{}_count{{stage="{}"}} {}'.format(STAGE_HISTOGRAM, stage, histogram.count))
+            for name, description in COUNTERS:
+                lines.append("# HELP {} {}.".format(name, description))
+                lines.append("# TYPE {} counter".format(name))
+                for (counter_name, stage), value in sorted(
+                    self._counters.items(), key=lambda item: str(item[0][1])
+                ):
+                    if counter_name != name:
+                        continue
+                    labels = '{{stage="{}"}}'.format(stage) if stage else ""
+                    lines.append("{}{} {}".format(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+# Shared by the dispatcher, the handler and the worker thread
+dispatch_instrumentation = DispatchInstrumentation()
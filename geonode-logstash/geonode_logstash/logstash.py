@@ -17,50 +17,131 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 #########################################################################
+import sys
 import six
 import json
-import gzip
+import zlib
 import pytz
 import time
+import ssl
+import select
 import socket
+import struct
 import logging
+import threading
 import sqlite3
 import traceback
 import pycountry
 
+from types import MappingProxyType
 from datetime import datetime, timedelta
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import signals
+from django.urls import resolve, Resolver404
 from django.contrib.auth import get_user_model
 # from django_celery_beat.models import PeriodicTask
 
+from geonode.utils import raw_sql
 from geonode.maps.models import Map
 from geonode.layers.models import Layer
+from geonode.base.models import ResourceBase
 from geonode.documents.models import Document
-from geonode.monitoring.models import EventType
+from geonode.monitoring.models import BuiltIns, EventType, Metric, MonitoredResource, ExceptionEvent
 from geonode.monitoring.collector import CollectorAPI
 from geonode.monitoring.views import ExceptionsListView
 
 from logstash_async import EVENT_CACHE
 from logstash_async.constants import constants
-from logstash_async.database import DatabaseCache
-from logstash_async.transport import TcpTransport
+from logstash_async.database import DatabaseCache, DatabaseLockedError
+from logstash_async.transport import TcpTransport, TimeoutNotSet
 from logstash_async.memory_cache import MemoryCache
 from logstash_async.worker import LogProcessingWorker
 from logstash_async.formatter import LogstashFormatter
 from logstash_async.handler import AsynchronousLogstashHandler
 
-from io import StringIO, BytesIO
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 from .models import (
-    COUNTRIES_GEODB,
+    COUNTRIES_CENTERS,
     CentralizedServer
 )
+from .instrumentation import dispatch_instrumentation
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # Not available on Windows: framed batches are sent without waiting for TCP acks
+    fcntl = termios = None
+# The TCP acks are read from the unacknowledged bytes of the send queue, only Linux reports them
+# through TIOCOUTQ (on macOS and BSD the ioctl is about terminals only)
+TCP_ACK_SUPPORTED = fcntl is not None and sys.platform.startswith('linux') and hasattr(termios, 'TIOCOUTQ')
 
 log = logging.getLogger(__name__)
 
 IS_ENABLED = settings.MONITORING_ENABLED and settings.USER_ANALYTICS_ENABLED
 GZIP_COMPRESSED = getattr(settings, 'USER_ANALYTICS_GZIP', False)
+# Collect the metrics of all the data types on a thread pool
+CONCURRENT_DISPATCH = getattr(settings, 'USER_ANALYTICS_CONCURRENT_DISPATCH', False)
+DISPATCH_MAX_WORKERS = getattr(settings, 'USER_ANALYTICS_DISPATCH_MAX_WORKERS', 4)
+# First key of the PostgreSQL advisory lock serializing the dispatches (the second one is the
+# CentralizedServer id)
+DISPATCH_LOCK_ID = 0x6c6f6773
+
+# python-logstash-async constants configured by the CentralizedServer fields
+# (the library defaults are used when the related field is empty)
+CONSTANTS_FIELDS = (
+    ("SOCKET_TIMEOUT", "socket_timeout"),
+    ("QUEUE_CHECK_INTERVAL", "queue_check_interval"),
+    ("QUEUED_EVENTS_FLUSH_INTERVAL", "queue_events_flush_interval"),
+    ("QUEUED_EVENTS_FLUSH_COUNT", "queue_events_flush_count"),
+    ("QUEUED_EVENTS_BATCH_SIZE", "queue_events_batch_size"),
+    ("DATABASE_TIMEOUT", "logstash_db_timeout"),
+)
+CONSTANTS_DEFAULTS = MappingProxyType({
+    name: getattr(constants, name) for name, _field in CONSTANTS_FIELDS
+})
+
+# The "extra" counts of tables larger than ESTIMATED_COUNTS_MIN_ROWS are estimated from the
+# PostgreSQL statistics, exact counts are refreshed every EXACT_COUNTS_INTERVAL seconds
+ESTIMATED_COUNTS_MIN_ROWS = getattr(settings, 'USER_ANALYTICS_ESTIMATED_COUNTS_MIN_ROWS', 100000)
+EXACT_COUNTS_INTERVAL = getattr(settings, 'USER_ANALYTICS_EXACT_COUNTS_INTERVAL', 86400)
+
+# Aggregate the metrics once into a local spool and deliver them to all the CentralizedServer
+# instances in parallel (see LogstashSpoolDispatcher)
+SPOOL_DISPATCH = getattr(settings, 'USER_ANALYTICS_SPOOL_DISPATCH', False)
+SPOOL_PATH = getattr(settings, 'USER_ANALYTICS_SPOOL_PATH', 'logstash_spool.db')
+
+# JSON backend of the messages ("orjson", "ujson" or "json"), the fastest available one if not set
+JSON_SERIALIZER = getattr(settings, 'USER_ANALYTICS_JSON_SERIALIZER', None)
+
+# Metrics of DATA_TYPES_MAP sharing name and one of these "group_by" are retrieved with a single
+# query computing the value of each event type through conditional aggregation
+GROUPED_QUERY_GROUP_BY = ("resource",)
+# Columns grouped by CollectorAPI.get_metrics_data(group_by="resource"): the metric label and the
+# monitored resource (the user of each row is max(ml.user), as in CollectorAPI)
+GROUPED_QUERY_COLUMNS = ["ml.name", "mr.id", "mr.type", "mr.name", "mr.resource_id"]
+# Metrics not filtered by event type in CollectorAPI.get_metrics_data
+GROUPED_QUERY_EXCLUDED_METRICS = BuiltIns.host_metrics + ("response.error.count",)
 
 DATA_TYPES_MAP = [
     {
@@ -196,17 +277,37 @@ DATA_TYPES_MAP = [
 ]
 
 
+@lru_cache(maxsize=None)
+def get_country_iso_3(code):
+    """
+    Resolving a country ISO-3 code through pycountry (unknown codes are cached as well)
+    :param code: country code
+    :return: ISO-3 code or None
+    """
+    try:
+        return pycountry.countries.get(alpha_3=code).alpha_3
+    except (KeyError, LookupError, AttributeError):
+        return None
+
+
 class LogstashDispatcher(object):
     """
     Dispatcher of GeoNode metric data for Logstash server
     """
 
+    # Snapshot of the CentralizedServer configuration, cleared when the instance is saved
+    _config = None
+    _config_lock = threading.Lock()
+    # Time of the last exact count of the "extra" fields
+    _exact_counts_time = None
+
     def __init__(self):
         self._centralized_server = None
         self._logger = None
         self._handler = None
         self._interval = 0
         self._collector = None
+        self._transport_factory = None
         self._init_server()
 
     def _init_server(self):
@@ -217,6 +318,8 @@ class LogstashDispatcher(object):
         # self.manage_task()
         if IS_ENABLED:
             self._centralized_server = self._get_centralized_server()
+            # The instance has just been retrieved: other processes may have changed it
+            self._apply_config(self._set_config(self._centralized_server))
             if self._centralized_server:
                 # self._centralized_server.sync_periodic_task()
                 host = self._centralized_server.host
@@ -224,8 +327,16 @@ class LogstashDispatcher(object):
                 db_path = self._centralized_server.db_path if self._centralized_server.db_path else None
                 self._logger = logging.getLogger('geonode-logstash-logger')
                 self._logger.setLevel(logging.INFO)
+                self._transport_factory = partial(
+                    GeonodeTcpTransport,
+                    framing=get_transport_framing(self._centralized_server.transport_framing),
+                    max_batch_size=self._centralized_server.transport_max_batch_size
+                )
                 self._handler = GeonodeAsynchronousLogstashHandler(
-                    host, port, database_path=db_path, transport=GeonodeTcpTransport
+                    host, port, database_path=db_path, transport=self._transport_factory,
+                    ssl_enable=self._centralized_server.ssl_enable,
+                    compression=self._centralized_server.compression,
+                    compression_level=self._centralized_server.compression_level
                 )
                 self._logger.addHandler(self._handler)
                 # self.client_ip = socket.gethostbyname(socket.gethostname())
@@ -262,18 +373,72 @@ class LogstashDispatcher(object):
         except Exception:
             pass
 
+    @classmethod
+    def _get_config(cls):
+        """
+        Get the cached configuration, loading it from the CentralizedServer if needed
+        :return: read-only mapping of the python-logstash-async constants
+        """
+        config = cls._config
+        if config is None:
+            with cls._config_lock:
+                if cls._config is None:
+                    cls._config = cls._build_config(cls._get_centralized_server())
+                config = cls._config
+        return config
+
+    @classmethod
+    def _set_config(cls, cs):
+        """
+        Replace the cached configuration with the one of the given CentralizedServer
+        :param cs: CentralizedServer instance (or None)
+        :return: read-only mapping of the python-logstash-async constants
+        """
+        with cls._config_lock:
+            cls._config = cls._build_config(cs)
+            return cls._config
+
+    @classmethod
+    def invalidate_config(cls):
+        """
+        Clear the cached configuration, it will be loaded again on next access
+        :return: None
+        """
+        with cls._config_lock:
+            cls._config = None
+
+    @staticmethod
+    def _build_config(cs):
+        """
+        Build the configuration snapshot from the CentralizedServer fields
+        :param cs: CentralizedServer instance (or None)
+        :return: read-only mapping of the python-logstash-async constants
+        """
+        config = dict(CONSTANTS_DEFAULTS)
+        if cs:
+            for name, field in CONSTANTS_FIELDS:
+                value = getattr(cs, field)
+                if value is not None:
+                    config[name] = value
+        return MappingProxyType(config)
+
+    @staticmethod
+    def _apply_config(config):
+        """
+        Configuring the python-logstash-async constants used by the worker thread
+        :param config: configuration snapshot
+        :return: None
+        """
+        for name, value in config.items():
+            setattr(constants, name, value)
+
     @staticmethod
     def get_socket_timeout():
         """
         Configuring the SOCKET_TIMEOUT from the model
         :return: SOCKET_TIMEOUT
         """
-        cs = LogstashDispatcher._get_centralized_server()
-        if cs and cs.socket_timeout is not None:
-            log.debug(" ---------------------- socket_timeout %s " % cs.socket_timeout)
-            return cs.socket_timeout
-        else:
-            return constants.SOCKET_TIMEOUT
+        return LogstashDispatcher._get_config()["SOCKET_TIMEOUT"]
 
     @staticmethod
     def get_queue_check_interval():
@@ -281,11 +446,7 @@ class LogstashDispatcher(object):
         Configuring the QUEUE_CHECK_INTERVAL from the model
         :return: QUEUE_CHECK_INTERVAL
         """
-        cs = LogstashDispatcher._get_centralized_server()
-        if cs and cs.queue_check_interval is not None:
-            return cs.queue_check_interval
-        else:
-            return constants.QUEUE_CHECK_INTERVAL
+        return LogstashDispatcher._get_config()["QUEUE_CHECK_INTERVAL"]
 
     @staticmethod
     def get_queue_events_flush_interval():
@@ -293,11 +454,7 @@ class LogstashDispatcher(object):
         Configuring the QUEUED_EVENTS_FLUSH_INTERVAL from the model
         :return: QUEUED_EVENTS_FLUSH_INTERVAL
         """
-        cs = LogstashDispatcher._get_centralized_server()
-        if cs and cs.queue_events_flush_interval is not None:
-            return cs.queue_events_flush_interval
-        else:
-            return constants.QUEUED_EVENTS_FLUSH_INTERVAL
+        return LogstashDispatcher._get_config()["QUEUED_EVENTS_FLUSH_INTERVAL"]
 
     @staticmethod
     def get_queue_events_flush_count():
@@ -305,11 +462,7 @@ class LogstashDispatcher(object):
         Configuring the QUEUED_EVENTS_FLUSH_COUNT from the model
         :return: QUEUED_EVENTS_FLUSH_COUNT
         """
-        cs = LogstashDispatcher._get_centralized_server()
-        if cs and cs.queue_events_flush_count is not None:
-            return cs.queue_events_flush_count
-        else:
-            return constants.QUEUED_EVENTS_FLUSH_COUNT
+        return LogstashDispatcher._get_config()["QUEUED_EVENTS_FLUSH_COUNT"]
 
     @staticmethod
     def get_queue_events_batch_size():
@@ -317,11 +470,7 @@ class LogstashDispatcher(object):
         Configuring the QUEUED_EVENTS_BATCH_SIZE from the model
         :return: QUEUED_EVENTS_BATCH_SIZE
         """
-        cs = LogstashDispatcher._get_centralized_server()
-        if cs and cs.queue_events_batch_size is not None:
-            return cs.queue_events_batch_size
-        else:
-            return constants.QUEUED_EVENTS_BATCH_SIZE
+        return LogstashDispatcher._get_config()["QUEUED_EVENTS_BATCH_SIZE"]
 
     @staticmethod
     def get_logstash_db_timeout():
@@ -329,11 +478,7 @@ class LogstashDispatcher(object):
         Configuring the DATABASE_TIMEOUT from the model
         :return: DATABASE_TIMEOUT
         """
-        cs = LogstashDispatcher._get_centralized_server()
-        if cs and cs.logstash_db_timeout is not None:
-            return cs.logstash_db_timeout
-        else:
-            return constants.DATABASE_TIMEOUT
+        return LogstashDispatcher._get_config()["DATABASE_TIMEOUT"]
 
     def dispatch_metrics(self):
         """
@@ -342,25 +487,158 @@ class LogstashDispatcher(object):
         """
         if self._centralized_server:
             if IS_ENABLED:
-                for data_type in DATA_TYPES_MAP:
-                    try:
-                        msg = self._get_message(data_type)
-                        print(" ------------------------------------------------ ")
-                        print(msg)
-                        if msg:
-                            self._logger.info(msg)
-                            time.sleep(LogstashDispatcher.get_socket_timeout())
-                    except Exception as e:
-                        # Note: it catches exceptions on current thread only
-                        traceback.print_exc()
-                        log.error("Sending data failed: " + str(e))
-                # Updating CentralizedServer
-                self._update_server()
+                with self._dispatch_lock() as locked:
+                    if not locked:
+                        log.info("Another dispatch of the metrics is running.")
+                        return
+                    # The watermark may have been moved by the run holding the lock before
+                    self._centralized_server.refresh_from_db(
+                        fields=["last_successful_deliver", "last_queued_deliver"]
+                    )
+                    self._dispatch_windows()
             else:
                 log.error("Monitoring/analytics disabled, centralized server cannot be set up.")
         else:
             log.error("Centralized server not found.")
 
+    def _dispatch_windows(self):
+        """
+        Sending the messages of the time windows not dispatched yet.
+        A window is marked as queued only when the messages of all the data types have been
+        enqueued: the dispatch stops at the first failed window, which is retried on next run.
+        :return: None
+        """
+        windows = self._get_time_windows()
+        if not windows:
+            log.info("No time window to be dispatched before {}.".format(
+                self._centralized_server.next_scheduled_deliver))
+            return
+        messages_count = 0
+        dispatched = None
+        for valid_from, valid_to in windows:
+            self._set_time_range(valid_from, valid_to)
+            messages, failed = self._get_window_messages()
+            enqueued = self._enqueue_messages(messages)
+            messages_count += enqueued
+            if failed or enqueued < len(messages):
+                log.error("Time window {} - {} not dispatched, it will be retried.".format(valid_from, valid_to))
+                break
+            # Events are cached locally until delivered: the window must not be aggregated again
+            self._centralized_server.last_queued_deliver = valid_to
+            self._centralized_server.save(update_fields=["last_queued_deliver"])
+            dispatched = (valid_from, valid_to)
+        if messages_count:
+            self._wait_for_delivery(messages_count)
+        if dispatched:
+            # Updating CentralizedServer up to the last window dispatched
+            self._set_time_range(*dispatched)
+            self._update_server()
+
+    @contextmanager
+    def _dispatch_lock(self):
+        """
+        Serialize the dispatches of a CentralizedServer (PostgreSQL session advisory lock)
+        :return: whether the lock has been acquired
+        """
+        if connection.vendor != "postgresql":
+            yield True
+            return
+        key = (DISPATCH_LOCK_ID, self._centralized_server.pk or 0)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s, %s);", key)
+            locked = cursor.fetchone()[0]
+        try:
+            yield locked
+        finally:
+            if locked:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_unlock(%s, %s);", key)
+
+    def _get_window_messages(self):
+        """
+        Retrieving the messages of the current time window
+        :return: (list of messages, number of data types failed)
+        """
+        if CONCURRENT_DISPATCH:
+            return self._collect_messages()
+        messages = []
+        failed = 0
+        for data_type in DATA_TYPES_MAP:
+            try:
+                msg = self._get_message(data_type)
+                log.debug(msg)
+                if msg:
+                    messages.append(msg)
+            except Exception as e:
+                failed += 1
+                traceback.print_exc()
+                log.error("Retrieving data failed: " + str(e))
+        return messages, failed
+
+    def _enqueue_messages(self, messages):
+        """
+        Sending the messages to the handler queue
+        :param messages: list of messages
+        :return: number of messages enqueued
+        """
+        count = 0
+        for msg in messages:
+            try:
+                with dispatch_instrumentation.time("enqueue"):
+                    self._logger.info(msg)
+                count += 1
+            except Exception as e:
+                traceback.print_exc()
+                log.error("Sending data failed: " + str(e))
+        return count
+
+    def _wait_for_delivery(self, messages_count):
+        """
+        Waiting for the worker thread to consume the queued events
+        :param messages_count: number of messages enqueued
+        :return: None
+        """
+        # Upper bound of SOCKET_TIMEOUT seconds per message, but we stop waiting as soon as
+        # the worker thread has consumed all the queued events
+        timeout = LogstashDispatcher.get_socket_timeout() * messages_count
+        if not self._handler.wait_for_queue_drain(timeout):
+            log.warning("Logstash worker queue not drained after {} seconds.".format(timeout))
+
+    def _collect_messages(self):
+        """
+        Retrieving the messages of all the data types concurrently
+        :return: (list of messages in the same order of DATA_TYPES_MAP, number of data types failed)
+        """
+        with ThreadPoolExecutor(max_workers=DISPATCH_MAX_WORKERS) as executor:
+            futures = [
+                executor.submit(self._get_message_in_thread, data_type)
+                for data_type in DATA_TYPES_MAP
+            ]
+        messages = []
+        failed = 0
+        for future in futures:
+            try:
+                msg = future.result()
+                if msg:
+                    messages.append(msg)
+            except Exception as e:
+                failed += 1
+                traceback.print_exc()
+                log.error("Retrieving data failed: " + str(e))
+        return messages, failed
+
+    def _get_message_in_thread(self, data_type):
+        """
+        Wrapper of _get_message to be executed by the thread pool
+        :param data_type: field mapping to keep only interesting information
+        :return: data dictionary
+        """
+        try:
+            return self._get_message(data_type)
+        finally:
+            # Each thread opens its own database connection, we have to release it
+            connection.close()
+
     def _update_server(self):
         """
         Updating the CentralizedServer instance
@@ -380,26 +658,70 @@ class LogstashDispatcher(object):
         self._centralized_server.next_scheduled_deliver = self._valid_to + timedelta(
             seconds=self._centralized_server.interval
         )
-        self._centralized_server.save()
+        self._centralized_server.save(update_fields=[
+            "last_successful_deliver", "last_failed_deliver", "next_scheduled_deliver"
+        ])
 
-    def _set_time_range(self):
+    def _set_time_range(self, valid_from=None, valid_to=None):
         """
         Set up the time range as valid_to/valid_from and interval
+        :param valid_from: start of the time range (by default valid_to - interval)
+        :param valid_to: end of the time range (by default now)
         :return: None
         """
-        self._valid_to = datetime.utcnow().replace(tzinfo=pytz.utc)
-        self._valid_from = self._valid_to - timedelta(
+        self._valid_to = valid_to or datetime.utcnow().replace(tzinfo=pytz.utc)
+        self._valid_from = valid_from or self._valid_to - timedelta(
             seconds=self._centralized_server.interval
         )
         self._valid_from = self._valid_from.replace(tzinfo=pytz.utc)
         self._interval = (self._valid_to - self._valid_from).total_seconds()
 
+    def _get_time_windows(self):
+        """
+        Split the time range not dispatched yet into interval-sized windows.
+        The watermark is the end of the last window delivered (or queued in the local cache):
+        missed runs are backfilled and overlapping runs do not send the same window twice.
+        :return: list of (valid_from, valid_to) tuples
+        """
+        now = datetime.utcnow().replace(tzinfo=pytz.utc)
+        interval = timedelta(seconds=self._centralized_server.interval)
+        valid_from = self._get_watermark()
+        if valid_from is None:
+            # First dispatch: the last interval
+            return [(now - interval, now)]
+        # Monitoring data older than MONITORING_DATA_TTL have been already removed
+        data_ttl = getattr(settings, 'MONITORING_DATA_TTL', None)
+        if isinstance(data_ttl, timedelta) and valid_from < now - data_ttl:
+            skipped = (now - data_ttl - valid_from) // interval
+            log.warning("Skipping {} time windows older than MONITORING_DATA_TTL.".format(skipped))
+            valid_from += skipped * interval
+        windows = []
+        while valid_from + interval <= now:
+            windows.append((valid_from, valid_from + interval))
+            valid_from += interval
+        return windows
+
+    def _get_watermark(self):
+        """
+        End of the last time window delivered (or queued in the local cache)
+        :return: datetime or None
+        """
+        watermarks = [
+            w for w in (
+                self._centralized_server.last_successful_deliver,
+                self._centralized_server.last_queued_deliver
+            ) if w
+        ]
+        return max(watermarks) if watermarks else None
+
     def _get_message(self, data_type):
         """
         Retrieving data querying the MetricValue model
         :param data_type: field mapping to keep only interesting information
         :return: data dictionary
         """
+        start = time.perf_counter()
+        query_time = 0.0
         has_data = False
         # Name of the object read by logstash filter (not used in case of "overview")
         data_name = data_type["name"]
@@ -416,27 +738,36 @@ class LogstashDispatcher(object):
                 "endTime": self._valid_to.isoformat()
             }
         }
-        # List data container (not used in case of "overview")
-        list_data = []
+        # List data container indexed by name (not used in case of "overview")
+        list_data = OrderedDict()
+        # Metrics of the same family are retrieved by a single query
+        with dispatch_instrumentation.time("query") as timer:
+            families_data = self._get_families_data(data_type)
+        query_time += timer.elapsed
         # For each metric we want to execute a query
-        for metric in data_type["metrics"]:
+        for idx, metric in enumerate(data_type["metrics"]):
             # Name omitted in hooks when retrieving no-list data (es. "overview")
             is_list = "name" in metric["hooks"]
-            group_by = metric["params"]["group_by"] \
-                if "params" in metric and "group_by" in metric["params"] \
-                else None
-            event_type = EventType.get(metric["params"]["event_type"]) \
-                if "params" in metric and "event_type" in metric["params"] \
-                else None
-            # Retrieving data through the CollectorAPI object
-            metrics_data = self._collector.get_metrics_data(
-                metric_name=metric["name"],
-                valid_from=self._valid_from,
-                valid_to=self._valid_to,
-                interval=self._interval,
-                event_type=event_type,
-                group_by=group_by
-            )
+            if idx in families_data:
+                metrics_data = families_data[idx]
+            else:
+                group_by = metric["params"]["group_by"] \
+                    if "params" in metric and "group_by" in metric["params"] \
+                    else None
+                event_type = EventType.get(metric["params"]["event_type"]) \
+                    if "params" in metric and "event_type" in metric["params"] \
+                    else None
+                # Retrieving data through the CollectorAPI object
+                with dispatch_instrumentation.time("query") as timer:
+                    metrics_data = self._collector.get_metrics_data(
+                        metric_name=metric["name"],
+                        valid_from=self._valid_from,
+                        valid_to=self._valid_to,
+                        interval=self._interval,
+                        event_type=event_type,
+                        group_by=group_by
+                    )
+                query_time += timer.elapsed
             if metrics_data:
                 # data dictionary updating
                 for item in metrics_data:
@@ -446,39 +777,262 @@ class LogstashDispatcher(object):
                         k: self._build_data(item, v)
                         for k, v in metric["hooks"].items()
                     }
-                    if "countries" == data_name:
-                        try:
-                            country_iso_3 = pycountry.countries.get(
-                                alpha_3=name_value).alpha_3
-                            center = self._get_country_center(country_iso_3)
-                            item_value['center'] = center or ''
-                        except Exception as e:
-                            log.error(str(e))
                     if is_list:
-                        try:
-                            list_item = filter(
-                                lambda l_item: l_item["name"] == name_value, list_data
-                            )
-                            _idx = list(list_item)[0]
-                            i = list_data.index(_idx)
-                            list_data[i].update(item_value)
-                        except (IndexError, ValueError) as e:
-                            list_data.append(item_value)
+                        if name_value in list_data:
+                            list_data[name_value].update(item_value)
+                        else:
+                            list_data[name_value] = item_value
                     else:
                         data.update(item_value)
                         has_data = True
+        if "countries" == data_name:
+            self._set_countries_center(list_data.values())
         if list_data:
-            data.update({data_name: list_data})
+            data.update({data_name: list(list_data.values())})
             has_data = True
         if "extra" in data_type:
-            for extra in data_type["extra"]:
-                # For each "extra" entry we have to define a "_get_{extra}" method
-                data.update({
-                    extra: getattr(self, '_get_{}'.format(extra))()
-                })
-                has_data = True
+            with dispatch_instrumentation.time("query") as timer:
+                data.update(self._get_extras(data_type["extra"]))
+            query_time += timer.elapsed
+            has_data = True
+        dispatch_instrumentation.observe("build", time.perf_counter() - start - query_time)
+        if has_data:
+            dispatch_instrumentation.inc("geonode_logstash_messages_total")
         return data if has_data else None
 
+    def _get_extras(self, extras):
+        """
+        Retrieving the "extra" fields, the counts are computed with a single query
+        :param extras: list of "extra" entries
+        :return: dictionary of extra data
+        """
+        try:
+            # Savepoint: a failed query must not break the transaction of the single queries
+            with transaction.atomic():
+                counts = self._get_extras_counts(extras)
+        except Exception as e:
+            # The single queries will be used
+            traceback.print_exc()
+            log.error("Extra fields query failed: " + str(e))
+            counts = {}
+        # For each other "extra" entry we have to define a "_get_{extra}" method
+        return {
+            extra: counts[extra] if extra in counts else getattr(self, '_get_{}'.format(extra))()
+            for extra in extras
+        }
+
+    def _get_extras_counts(self, extras):
+        """
+        Retrieving the counts of the "extra" fields with a single query.
+        Large tables are counted through the pg_class.reltuples estimate, unless
+        the exact counts have not been refreshed for EXACT_COUNTS_INTERVAL seconds.
+        :param extras: list of "extra" entries
+        :return: dictionary of counts (only the supported entries)
+        """
+        counted_models = {
+            "registered_users": get_user_model(),
+            "layers": Layer,
+            "maps": Map,
+            "documents": Document
+        }
+        now = time.time()
+        exact = (
+            LogstashDispatcher._exact_counts_time is None or
+            now - LogstashDispatcher._exact_counts_time >= EXACT_COUNTS_INTERVAL
+        )
+        params = {
+            "min_rows": ESTIMATED_COUNTS_MIN_ROWS,
+            "valid_from": self._valid_from.replace(tzinfo=pytz.utc).isoformat(),
+            "valid_to": self._valid_to.replace(tzinfo=pytz.utc).isoformat()
+        }
+        q_select = []
+        for extra in extras:
+            if extra in counted_models:
+                table = counted_models[extra]._meta.db_table
+                count = "select count(*) from {}".format(connection.ops.quote_name(table))
+                if not exact:
+                    # The exact count is computed only when the table statistics report few rows
+                    params["{}_table".format(extra)] = table
+                    count = (
+                        "select case when reltuples >= %(min_rows)s then reltuples::bigint else ({}) end "
+                        "from pg_class where oid = %({}_table)s::regclass"
+                    ).format(count, extra)
+            elif extra == "errors":
+                # Same filters of ExceptionsListView
+                count = (
+                    "select count(*) from {} "
+                    "where created >= TIMESTAMP %(valid_from)s AT TIME ZONE 'UTC' "
+                    "and created <= TIMESTAMP %(valid_to)s AT TIME ZONE 'UTC'"
+                ).format(connection.ops.quote_name(ExceptionEvent._meta.db_table))
+            else:
+                continue
+            q_select.append("({}) as {}".format(count, extra))
+        if not q_select:
+            return {}
+        with connection.cursor() as cursor:
+            cursor.execute("select " + ", ".join(q_select), params)
+            columns = [col[0] for col in cursor.description]
+            counts = dict(zip(columns, cursor.fetchone()))
+        if exact:
+            LogstashDispatcher._exact_counts_time = now
+        return {extra: int(count) for extra, count in counts.items()}
+
+    def _get_families_data(self, data_type):
+        """
+        Retrieving data of the metrics sharing name and grouping with a single query
+        :param data_type: field mapping to keep only interesting information
+        :return: dictionary of metrics data by metric index in data_type["metrics"]
+        """
+        families = {}
+        for idx, metric in enumerate(data_type["metrics"]):
+            params = metric.get("params", {})
+            group_by = params.get("group_by")
+            if group_by in GROUPED_QUERY_GROUP_BY:
+                families.setdefault((metric["name"], group_by), []).append(
+                    (idx, params.get("event_type", EventType.EVENT_ALL))
+                )
+        output = {}
+        for (metric_name, group_by), members in families.items():
+            if len(members) < 2 or metric_name in GROUPED_QUERY_EXCLUDED_METRICS:
+                # Nothing to gain, the CollectorAPI will be used
+                continue
+            try:
+                # Savepoint: a failed query must not break the transaction of the fallback queries
+                with transaction.atomic():
+                    grouped_data = self._get_grouped_metrics_data(
+                        metric_name, [event_type for _idx, event_type in members]
+                    )
+            except Exception as e:
+                # Falling back to a query for each metric
+                traceback.print_exc()
+                log.error("Grouped query for {} failed: {}".format(metric_name, str(e)))
+                continue
+            for idx, event_type in members:
+                output[idx] = grouped_data[event_type]
+        return output
+
+    def _get_grouped_metrics_data(self, metric_name, event_types):
+        """
+        Retrieving the metric values grouped by resource for several event types at once.
+        It mirrors CollectorAPI.get_metrics_data(group_by="resource") but the MetricValue rows
+        are scanned only once: each event type value is computed through conditional aggregation.
+        :param metric_name: name of the metric
+        :param event_types: list of EventType names
+        :return: dictionary of metrics data (same format of CollectorAPI) by event type name
+        """
+        event_types = list(dict.fromkeys(event_types))
+        params = {
+            "metric_name": metric_name,
+            "valid_from": self._valid_from.replace(tzinfo=pytz.utc).isoformat(),
+            "valid_to": self._valid_to.replace(tzinfo=pytz.utc).isoformat()
+        }
+        metric = Metric.get_for(metric_name)
+        if not metric:
+            raise ValueError("Invalid metric {}".format(metric_name))
+        q_select = ["select ml.name as label, max(ml.user) as user"]
+        q_event_types = []
+        for i, event_type in enumerate(event_types):
+            params["event_type_{}".format(i)] = EventType.get(event_type).id
+            q_event_types.append("%(event_type_{})s".format(i))
+            q_select.append(", {} as val_{}".format(self._get_conditional_aggregate(metric, i), i))
+            # Groups without values of the event type are not returned by CollectorAPI
+            q_select.append(
+                ", count(case when mv.event_type_id = %(event_type_{0})s then 1 end) as count_{0}".format(i)
+            )
+        q_select.append(", {}".format(", ".join(GROUPED_QUERY_COLUMNS[1:])))
+        q_from = [
+            "from monitoring_metricvalue mv",
+            "join monitoring_servicetypemetric mt on (mv.service_metric_id = mt.id)",
+            "join monitoring_metric m on (m.id = mt.metric_id)",
+            "join monitoring_metriclabel ml on (mv.label_id = ml.id)",
+            "join monitoring_monitoredresource mr on (mv.resource_id = mr.id)"
+        ]
+        q_where = [
+            "where ((mv.valid_from >= TIMESTAMP %(valid_from)s AT TIME ZONE 'UTC'",
+            "and mv.valid_to < TIMESTAMP %(valid_to)s AT TIME ZONE 'UTC')",
+            "or (mv.valid_from > TIMESTAMP %(valid_from)s AT TIME ZONE 'UTC'",
+            "and mv.valid_to <= TIMESTAMP %(valid_to)s AT TIME ZONE 'UTC'))",
+            "and m.name = %(metric_name)s",
+            "and mv.event_type_id in ({})".format(", ".join(q_event_types)),
+            "and mv.resource_id is not NULL"
+        ]
+        q_group = ["group by {}".format(", ".join(GROUPED_QUERY_COLUMNS))]
+        q = " ".join(q_select + q_from + q_where + q_group)
+        rows = list(raw_sql(q, params))
+        if metric_name == "request.country":
+            # Same filter of CollectorAPI (dirty "count" labels)
+            rows = [row for row in rows if row["label"] != "count"]
+        hrefs = {}
+        output = {}
+        for i, event_type in enumerate(event_types):
+            val_col = "val_{}".format(i)
+            count_col = "count_{}".format(i)
+            metrics_data = []
+            # CollectorAPI orders the rows by "val desc"
+            for row in sorted(
+                (row for row in rows if row[count_col]),
+                key=lambda row: row[val_col], reverse=True
+            ):
+                metrics_data.append({
+                    "label": row["label"],
+                    "user": row["user"],
+                    "val": row[val_col],
+                    "resource": self._get_resource(row, hrefs)
+                })
+            output[event_type] = metrics_data
+        return output
+
+    @staticmethod
+    def _get_conditional_aggregate(metric, i):
+        """
+        Build the aggregate of Metric.AGGREGATE_MAP restricted to the rows of an event type
+        :param metric: Metric instance
+        :param i: index of the event type parameter ("event_type_<i>")
+        :return: SQL expression
+        """
+        def when(expression):
+            return "case when mv.event_type_id = %(event_type_{})s then {} end".format(i, expression)
+
+        if metric.type == Metric.TYPE_RATE:
+            return (
+                "(case when sum({samples}) > 0 then sum({weighted}) / sum({samples}) else 0 end)"
+            ).format(samples=when("mv.samples_count"), weighted=when("mv.value_num * mv.samples_count"))
+        if metric.type in (Metric.TYPE_VALUE, Metric.TYPE_COUNT):
+            return "sum({})".format(when("mv.value_num"))
+        if metric.type == Metric.TYPE_VALUE_NUMERIC:
+            return "max({})".format(when("mv.value_num"))
+        raise ValueError("Metric type {} cannot be aggregated".format(metric.type))
+
+    @staticmethod
+    def _get_resource(row, hrefs):
+        """
+        Build the "resource" dictionary the same way CollectorAPI does
+        :param row: query result row
+        :param hrefs: cache of the already resolved hrefs by resource id
+        :return: resource dictionary
+        """
+        resource = {
+            "name": row["name"],
+            "type": row["type"],
+            "id": row["id"]
+        }
+        if row["id"] not in hrefs:
+            href = ""
+            if row["type"] == MonitoredResource.TYPE_URL:
+                try:
+                    resolve(row["name"])
+                    href = row["name"]
+                except Resolver404:
+                    pass
+            elif row["resource_id"] is not None:
+                try:
+                    href = ResourceBase.objects.get(id=row["resource_id"]).detail_url
+                except Exception:
+                    pass
+            hrefs[row["id"]] = href
+        resource["href"] = hrefs[row["id"]]
+        return resource
+
     @staticmethod
     def _build_data(item, key):
         """
@@ -546,14 +1100,30 @@ class LogstashDispatcher(object):
             interval=self._interval
         ).count()
 
+    @staticmethod
+    def _set_countries_center(countries):
+        """
+        Joining the countries with their center: the centers of the distinct countries are resolved once,
+        then the rows are joined with the mapping
+        :param countries: countries data
+        :return: None
+        """
+        countries = list(countries)
+        iso_3_codes = {name: get_country_iso_3(name) for name in {country["name"] for country in countries}}
+        for name in sorted(name for name, iso_3 in iso_3_codes.items() if iso_3 is None):
+            log.error("Country {} not found.".format(name))
+        centers = {
+            name: LogstashDispatcher._get_country_center(iso_3) or ''
+            for name, iso_3 in iso_3_codes.items() if iso_3 is not None
+        }
+        for country in countries:
+            if country["name"] in centers:
+                country["center"] = centers[country["name"]]
+
     @staticmethod
     def _get_country_center(iso_3):
-        output = None
-        for _cnt in COUNTRIES_GEODB:
-            if iso_3 == _cnt['country.iso_3']:
-                output = [float(i) for i in _cnt['country.center']]
-                break
-        return output
+        center = COUNTRIES_CENTERS.get(iso_3)
+        return list(center) if center else None
 
     def test_dispatch(self, host=None, port=None):
         """
@@ -569,13 +1139,346 @@ class LogstashDispatcher(object):
                 },
                 "test": "test"
             }
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(constants.SOCKET_TIMEOUT)
             test_host = host if host else self._centralized_server.host
             test_port = int(port) if port else self._centralized_server.port
-            sock.connect((test_host, test_port))
             compressed_msg = self._handler.formatter.json_gzip(test_msg)
-            sock.sendall(compressed_msg)
+            if compressed_msg is None:
+                raise ValueError("The test message cannot be compressed")
+            transport = self._transport_factory(
+                host=test_host,
+                port=test_port,
+                ssl_enable=self._centralized_server.ssl_enable,
+                ssl_verify=True,
+                keyfile=None,
+                certfile=None,
+                ca_certs=None,
+                timeout=constants.SOCKET_TIMEOUT
+            )
+            try:
+                transport.send([bytes(compressed_msg)])
+            finally:
+                # The test host may not be the configured one: no connections are left open
+                GeonodeConnectionPool.close_all()
+
+
+class LogstashSpoolDispatcher(LogstashDispatcher):
+    """
+    Dispatcher of GeoNode metric data for several Logstash servers.
+    The payloads of each time window are aggregated and serialized once into a local spool,
+    then every CentralizedServer is delivered in parallel starting from its own cursor.
+    """
+
+    def __init__(self):
+        self._servers = []
+        self._spool = None
+        self._serializer = GeonodeLogstashSerializer()
+        super(LogstashSpoolDispatcher, self).__init__()
+
+    def _init_server(self):
+        """
+        Initializing Dispatcher with the spool and all the centralized servers
+        :return: None
+        """
+        if IS_ENABLED:
+            try:
+                self._servers = list(CentralizedServer.objects.order_by('id'))
+            except Exception as e:
+                log.error("Centralized servers not found: " + str(e))
+            # The first server drives the aggregation (interval and local IP)
+            self._centralized_server = self._servers[0] if self._servers else None
+            self._apply_config(self._set_config(self._centralized_server))
+            if self._centralized_server:
+                self._spool = GeonodeMetricSpool(SPOOL_PATH)
+                self.client_ip = self._centralized_server.local_ip
+                self._collector = CollectorAPI()
+                self._set_time_range()
+        else:
+            log.error("Monitoring/analytics disabled, centralized server cannot be set up.")
+
+    def dispatch_metrics(self):
+        """
+        Spooling the messages of the new time windows and delivering them to all the servers
+        :return: None
+        """
+        if self._centralized_server:
+            if IS_ENABLED:
+                with self._dispatch_lock() as locked:
+                    if not locked:
+                        log.info("Another dispatch of the metrics is running.")
+                        self._spool.close()
+                        return
+                    try:
+                        for cs in self._servers:
+                            cs.refresh_from_db()
+                        for valid_from, valid_to in self._get_time_windows():
+                            self._set_time_range(valid_from, valid_to)
+                            messages, failed = self._collect_messages()
+                            if failed:
+                                # Not spooled: the watermark does not move past the window
+                                log.error("Time window {} - {} not spooled, it will be retried.".format(
+                                    valid_from, valid_to))
+                                break
+                            self._spool_messages(messages)
+                        # Windows failed on previous runs are retried as well
+                        self._fan_out()
+                    finally:
+                        self._spool.close()
+            else:
+                log.error("Monitoring/analytics disabled, centralized server cannot be set up.")
+        else:
+            log.error("Centralized server not found.")
+
+    def _get_watermark(self):
+        """
+        End of the last time window spooled (or delivered to any server)
+        :return: datetime or None
+        """
+        watermark = self._spool.get_last_valid_to()
+        if watermark is None:
+            watermarks = [
+                w for w in (cs.last_successful_deliver for cs in self._servers) if w
+            ]
+            watermark = max(watermarks) if watermarks else None
+        return watermark
+
+    def _spool_messages(self, messages):
+        """
+        Serializing the messages of the current time window into the spool
+        :param messages: list of messages
+        :return: None
+        """
+        payloads = [self._serializer.dumps_message(msg) for msg in messages]
+        # Windows without messages are spooled as well, to move the watermark forward
+        self._spool.add_window(self._valid_from, self._valid_to, payloads)
+
+    def _fan_out(self):
+        """
+        Delivering the spooled windows to all the servers in parallel, so that a slow
+        or unreachable server does not delay the others
+        :return: None
+        """
+        with ThreadPoolExecutor(max_workers=len(self._servers)) as executor:
+            futures = [
+                (cs, executor.submit(self._deliver_in_thread, cs)) for cs in self._servers
+            ]
+        for cs, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                traceback.print_exc()
+                log.error("Delivery to {}:{} failed: {}".format(cs.host, cs.port, str(e)))
+        cursors = [cs.spool_cursor for cs in self._servers]
+        data_ttl = getattr(settings, 'MONITORING_DATA_TTL', None)
+        self._spool.prune(
+            min(cursors) if None not in cursors else None,
+            datetime.utcnow().replace(tzinfo=pytz.utc) - data_ttl if isinstance(data_ttl, timedelta) else None
+        )
+
+    def _deliver_in_thread(self, cs):
+        """
+        Wrapper of _deliver to be executed by the thread pool
+        :param cs: CentralizedServer instance
+        :return: None
+        """
+        try:
+            self._deliver(cs)
+        finally:
+            # Each thread opens its own database connection, we have to release it
+            connection.close()
+
+    def _deliver(self, cs):
+        """
+        Delivering the spooled windows after the server cursor, one window at a time.
+        The cursor is moved forward only when the window has been sent: next run retries from there.
+        :param cs: CentralizedServer instance
+        :return: None
+        """
+        windows = self._spool.get_windows(cs.spool_cursor)
+        if cs.spool_cursor is None:
+            # New server: the delivery starts from the last window
+            windows = windows[-1:]
+        if not windows:
+            return
+        transport = GeonodeTcpTransport(
+            host=cs.host,
+            port=cs.port,
+            ssl_enable=cs.ssl_enable,
+            ssl_verify=True,
+            keyfile=None,
+            certfile=None,
+            ca_certs=None,
+            timeout=cs.socket_timeout if cs.socket_timeout is not None else CONSTANTS_DEFAULTS["SOCKET_TIMEOUT"],
+            framing=get_transport_framing(cs.transport_framing),
+            max_batch_size=cs.transport_max_batch_size
+        )
+        compressor = GeonodeLogstashCompressor(cs.compression, cs.compression_level) if GZIP_COMPRESSED else None
+        for window_id, valid_from, valid_to in windows:
+            events = self._spool.get_payloads(window_id)
+            if compressor:
+                events = [compressor.compress(event) for event in events]
+            try:
+                if events:
+                    transport.send(events)
+            except Exception as e:
+                cs.last_failed_deliver = datetime.utcnow().replace(tzinfo=pytz.utc)
+                cs.save(update_fields=["last_failed_deliver"])
+                log.error("Delivery to {}:{} failed: {}".format(cs.host, cs.port, str(e)))
+                return
+            cs.spool_cursor = window_id
+            cs.last_successful_deliver = valid_to
+            cs.last_failed_deliver = None
+            cs.next_scheduled_deliver = valid_to + timedelta(seconds=cs.interval)
+            cs.save(update_fields=[
+                "spool_cursor", "last_successful_deliver", "last_failed_deliver", "next_scheduled_deliver"
+            ])
+
+
+class GeonodeMetricSpool(object):
+    """
+    Local SQLite spool of the serialized metric payloads, grouped by time window.
+    The ids of the windows are never reused, so they are used as delivery cursors.
+    """
+    SCHEMA_STATEMENTS = [
+        """CREATE TABLE IF NOT EXISTS `window` (
+            `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+            `valid_from` REAL NOT NULL,
+            `valid_to` REAL NOT NULL);""",
+        """CREATE TABLE IF NOT EXISTS `payload` (
+            `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+            `window_id` INTEGER NOT NULL,
+            `data` BLOB NOT NULL);""",
+        """CREATE INDEX IF NOT EXISTS `idx_window_id` ON `payload` (window_id);""",
+    ]
+
+    def __init__(self, database_path):
+        self._database_path = database_path
+        self._connection = None
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def _connect(self):
+        """
+        Keep the connection open (shared by the delivery threads)
+        :return: connection
+        """
+        with self._lock:
+            if self._connection is None:
+                self._open()
+            with self._connection as connection:
+                yield connection
+
+    def _open(self):
+        """
+        Open the connection in WAL mode and initialize the schema
+        :return: None
+        """
+        self._connection = sqlite3.connect(
+            self._database_path,
+            timeout=constants.DATABASE_TIMEOUT,
+            check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL;')
+        self._connection.execute('PRAGMA synchronous=NORMAL;')
+        for statement in self.SCHEMA_STATEMENTS:
+            self._connection.execute(statement)
+
+    def add_window(self, valid_from, valid_to, payloads):
+        """
+        Store the payloads of a time window
+        :param valid_from: start of the time window
+        :param valid_to: end of the time window
+        :param payloads: list of serialized payloads
+        :return: id of the window
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "INSERT INTO `window` (`valid_from`, `valid_to`) VALUES (?, ?);",
+                (valid_from.timestamp(), valid_to.timestamp())
+            )
+            window_id = cursor.lastrowid
+            connection.executemany(
+                "INSERT INTO `payload` (`window_id`, `data`) VALUES (?, ?);",
+                ((window_id, sqlite3.Binary(payload)) for payload in payloads)
+            )
+        return window_id
+
+    def get_windows(self, after_id=None):
+        """
+        Get the time windows following the given one
+        :param after_id: id of the last window delivered (None for all the windows)
+        :return: list of (id, valid_from, valid_to) tuples
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT `id`, `valid_from`, `valid_to` FROM `window` WHERE `id` > ? ORDER BY `id`;",
+                (after_id or 0,)
+            ).fetchall()
+        return [
+            (row[0], datetime.fromtimestamp(row[1], pytz.utc), datetime.fromtimestamp(row[2], pytz.utc))
+            for row in rows
+        ]
+
+    def get_payloads(self, window_id):
+        """
+        Get the payloads of a time window
+        :param window_id: id of the window
+        :return: list of serialized payloads
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT `data` FROM `payload` WHERE `window_id` = ? ORDER BY `id`;", (window_id,)
+            ).fetchall()
+        return [bytes(row[0]) for row in rows]
+
+    def get_last_valid_to(self):
+        """
+        Get the end of the last time window spooled
+        :return: datetime or None
+        """
+        with self._connect() as connection:
+            row = connection.execute("SELECT MAX(`valid_to`) FROM `window`;").fetchone()
+        return datetime.fromtimestamp(row[0], pytz.utc) if row[0] is not None else None
+
+    def prune(self, delivered_id=None, valid_before=None):
+        """
+        Delete the payloads delivered to all the servers (or too old to be delivered).
+        The last window is kept to preserve the watermark.
+        :param delivered_id: id of the last window delivered to all the servers
+        :param valid_before: windows ending before this datetime are deleted anyway
+        :return: None
+        """
+        with self._connect() as connection:
+            if delivered_id is not None:
+                connection.execute("DELETE FROM `payload` WHERE `window_id` <= ?;", (delivered_id,))
+                connection.execute("DELETE FROM `window` WHERE `id` < ?;", (delivered_id,))
+            if valid_before is not None:
+                last_id = connection.execute("SELECT MAX(`id`) FROM `window`;").fetchone()[0]
+                connection.execute(
+                    "DELETE FROM `payload` WHERE `window_id` IN "
+                    "(SELECT `id` FROM `window` WHERE `valid_to` < ? AND `id` < ?);",
+                    (valid_before.timestamp(), last_id)
+                )
+                connection.execute(
+                    "DELETE FROM `window` WHERE `valid_to` < ? AND `id` < ?;",
+                    (valid_before.timestamp(), last_id)
+                )
+
+    def close(self):
+        """
+        Close the connection
+        :return: None
+        """
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def get_dispatcher():
+    """
+    Get the dispatcher configured through USER_ANALYTICS_SPOOL_DISPATCH
+    :return: dispatcher instance
+    """
+    return LogstashSpoolDispatcher() if SPOOL_DISPATCH else LogstashDispatcher()
 
 
 class GeonodeAsynchronousLogstashHandler(AsynchronousLogstashHandler):
@@ -584,8 +1487,12 @@ class GeonodeAsynchronousLogstashHandler(AsynchronousLogstashHandler):
     """
 
     def __init__(self, *args, **kwargs):
+        compression = kwargs.pop('compression', None)
+        compression_level = kwargs.pop('compression_level', None)
         super(GeonodeAsynchronousLogstashHandler, self).__init__(*args, **kwargs)
-        self.formatter = GeonodeLogstashFormatter(gzip=GZIP_COMPRESSED)
+        self.formatter = GeonodeLogstashFormatter(
+            gzip=GZIP_COMPRESSED, compression=compression, compression_level=compression_level
+        )
 
     def _start_worker_thread(self):
         """
@@ -625,59 +1532,414 @@ class GeonodeAsynchronousLogstashHandler(AsynchronousLogstashHandler):
         if self._worker_thread_is_running():
             return self._worker_thread.get_last_queued_event_date()
 
+    def wait_for_queue_drain(self, timeout):
+        """
+        Wait until the worker thread has consumed all the queued events
+        :param timeout: maximum number of seconds to wait
+        :return: True if the queue has been drained, False otherwise
+        """
+        deadline = time.time() + timeout
+        while self._worker_thread_is_running():
+            if self._worker_thread.is_queue_drained():
+                return True
+            if time.time() >= deadline:
+                break
+            # Let the worker flush the cached events as soon as they are written
+            self.flush()
+            time.sleep(constants.QUEUE_CHECK_INTERVAL)
+        return False
+
+
+class GeonodeLogstashSerializer(object):
+    """
+    JSON serializer of the messages producing bytes, through orjson or ujson when available.
+    The constant header fragments of the messages are serialized once.
+    """
+    BACKENDS = ("orjson", "ujson", "json")
+    HEADER_KEYS = ("format_version", "instance")
+
+    def __init__(self, backend=None, ensure_ascii=True):
+        self._ensure_ascii = ensure_ascii
+        self._headers = {}
+        backend = backend or JSON_SERIALIZER
+        modules = {"orjson": orjson, "ujson": ujson, "json": json}
+        available = [name for name in self.BACKENDS if modules[name] is not None]
+        if backend and backend not in available:
+            log.error("JSON serializer {} is not available, falling back to {}.".format(backend, available[0]))
+            backend = None
+        self.backend = backend or available[0]
+
+    def dumps(self, data):
+        """
+        Serialize the data
+        :param data: json serializable data
+        :return: serialized bytes
+        """
+        try:
+            if self.backend == "orjson":
+                # orjson always writes UTF-8, non-ASCII characters are not escaped
+                return orjson.dumps(data)
+            if self.backend == "ujson":
+                return ujson.dumps(data, ensure_ascii=self._ensure_ascii).encode('utf-8')
+        except (TypeError, OverflowError):
+            # Types not supported by the fast backends (stdlib errors are raised anyway)
+            pass
+        return json.dumps(data, ensure_ascii=self._ensure_ascii).encode('utf-8')
+
+    def dumps_message(self, data):
+        """
+        Serialize a message reusing the serialized header fragment (its keys come first)
+        :param data: message dictionary
+        :return: serialized bytes
+        """
+        if len(data) <= len(self.HEADER_KEYS) or not all(
+            isinstance(data.get(key), (str, dict)) for key in self.HEADER_KEYS
+        ):
+            return self.dumps(data)
+        header_key = tuple(
+            tuple(data[key].items()) if isinstance(data[key], dict) else data[key]
+            for key in self.HEADER_KEYS
+        )
+        try:
+            fragment = self._headers.get(header_key)
+        except TypeError:
+            # Not hashable header values
+            return self.dumps(data)
+        if fragment is None:
+            # b'{"format_version": ..., "instance": {...}}' without the outer braces
+            fragment = self.dumps({key: data[key] for key in self.HEADER_KEYS})[1:-1]
+            self._headers[header_key] = fragment
+        body = self.dumps({key: value for key, value in data.items() if key not in self.HEADER_KEYS})
+        return b'{' + fragment + b',' + body[1:]
+
+
+class GeonodeLogstashCompressor(object):
+    """
+    Reusable compressor of the serialized messages
+    """
+
+    def __init__(self, compression=None, level=None):
+        self._lock = threading.Lock()
+        self._zstd = None
+        self._gzip = None
+        if compression == CentralizedServer.COMPRESSION_ZSTD:
+            if zstandard is not None:
+                self._zstd = zstandard.ZstdCompressor(level=level if level is not None else 3)
+            else:
+                log.error("zstandard is not installed, falling back to gzip compression.")
+        if self._zstd is None:
+            # Pristine gzip stream state (wbits=31), copied for each message
+            self._gzip = zlib.compressobj(
+                level if level is not None else 9, zlib.DEFLATED, 31
+            )
+
+    def compress(self, data):
+        """
+        Compress the data
+        :param data: bytes to be compressed
+        :return: compressed bytes
+        """
+        with self._lock:
+            if self._zstd is not None:
+                return self._zstd.compress(data)
+            compressor = self._gzip.copy()
+            return compressor.compress(data) + compressor.flush()
+
 
 class GeonodeLogstashFormatter(LogstashFormatter):
     """
     Extends LogstashFormatter to allow gzip compression
     """
 
-    def __init__(self, gzip=False, *args, **kwargs):
+    def __init__(self, gzip=False, compression=None, compression_level=None, *args, **kwargs):
         super(GeonodeLogstashFormatter, self).__init__(*args, **kwargs)
+        # Set here: the serializer must not rely on the LogstashFormatter private attributes
+        self._ensure_ascii = kwargs.get('ensure_ascii', True)
         self._gzip = gzip
+        self._serializer = GeonodeLogstashSerializer(ensure_ascii=self._ensure_ascii)
+        self._compressor = GeonodeLogstashCompressor(compression, compression_level)
 
     def format(self, record):
         """
         Super method overriding to allow json compression
         :param record: message
         :return: gzip compressed message
-        :ref: https://stackoverflow.com/questions/8506897/how-do-i-gzip-compress-a-string-in-python
         """
-        _output = self._serialize(record.msg)
+        if self._gzip:
+            _output = self.json_gzip(record.msg)
+        else:
+            with dispatch_instrumentation.time("serialize"):
+                _output = self._serialize(record.msg)
+            if _output:
+                dispatch_instrumentation.inc("geonode_logstash_bytes_total", len(_output), stage="serialize")
         if _output is None or len(_output) == 0:
             log.error("No record.msg content found!")
             return None
-        if self._gzip:
-            _output = self.json_gzip(_output)
         return _output
 
+    def _serialize(self, message):
+        """
+        Super method override to serialize the messages through GeonodeLogstashSerializer
+        :param message: message
+        :return: serialized bytes
+        """
+        if isinstance(message, dict):
+            return self._serializer.dumps_message(message)
+        return super(GeonodeLogstashFormatter, self)._serialize(message)
+
     def json_gzip(self, data):
         """
-        Gzip compression of serialized json
-        :param j: input json to be compressed
-        :return: compressed object
+        Compression of serialized json (gzip or zstd according to the CentralizedServer)
+        :param data: input json (or already serialized json) to be compressed
+        :return: compressed bytes
         """
         gzip_j = None
         if data:
             try:
-                _out = BytesIO()
-                with gzip.GzipFile(fileobj=_out, mode="wb") as fout:
-                    if isinstance(data, six.string_types):
-                        data = data.encode('UTF-8')
-                    if isinstance(data, dict):
-                        data = json.dumps(data).encode('utf-8')
-                    fout.write(data)
-                    fout.flush()
-                gzip_j = sqlite3.Binary(_out.getvalue())
+                if isinstance(data, dict):
+                    with dispatch_instrumentation.time("serialize"):
+                        # Bytes straight into the compressor
+                        data = self._serializer.dumps_message(data)
+                if isinstance(data, six.string_types):
+                    data = data.encode('utf-8')
+                dispatch_instrumentation.inc("geonode_logstash_bytes_total", len(data), stage="serialize")
+                with dispatch_instrumentation.time("compress"):
+                    gzip_j = self._compressor.compress(data)
+                dispatch_instrumentation.inc("geonode_logstash_bytes_total", len(gzip_j), stage="compress")
             except Exception as e:
                 traceback.print_exc()
                 log.error(str(e))
         return gzip_j
 
 
+class GeonodeConnection(object):
+    """
+    Keep-alive TCP connection to a Logstash server
+    """
+
+    def __init__(self):
+        self.sock = None
+        self.lock = threading.RLock()
+        self.connects = 0
+        self.reconnects = 0
+        self.bytes_sent = 0
+
+    def ensure(self, factory):
+        """
+        Check the connection and (re)connect it if needed
+        :param factory: callable returning a new connected socket
+        :return: connected socket
+        """
+        if self.sock is not None and not self.is_healthy():
+            self.close()
+        if self.sock is None:
+            if self.connects:
+                self.reconnects += 1
+            self.sock = factory()
+            self.connects += 1
+        return self.sock
+
+    def is_healthy(self):
+        """
+        Check that the server has not closed or reset the connection.
+        Logstash never writes on the connection, so a readable socket means EOF or error
+        (or TLS records not carrying application data).
+        :return: True if the connection can be used
+        """
+        try:
+            readable, _writable, errored = select.select([self.sock], [], [self.sock], 0)
+        except (OSError, ValueError):
+            return False
+        if errored:
+            return False
+        if not readable:
+            return True
+        timeout = self.sock.gettimeout()
+        try:
+            self.sock.setblocking(False)
+            if isinstance(self.sock, ssl.SSLSocket):
+                data = self.sock.recv(1)
+            else:
+                data = self.sock.recv(1, socket.MSG_PEEK)
+            return bool(data)
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return True
+        except OSError:
+            return False
+        finally:
+            try:
+                self.sock.settimeout(timeout)
+            except OSError:
+                pass
+
+    def sendall(self, data):
+        """
+        Send data on the connection keeping track of the bytes sent
+        :param data: bytes to be sent
+        :return: None
+        """
+        self.sock.sendall(data)
+        self.bytes_sent += len(data)
+
+    def close(self):
+        """
+        Close the connection (it will be reopened by the next send)
+        :return: None
+        """
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    @property
+    def stats(self):
+        return {
+            "connected": self.sock is not None,
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "bytes_sent": self.bytes_sent
+        }
+
+
+class GeonodeConnectionPool(object):
+    """
+    Keep-alive connections to the Logstash servers shared by the transports,
+    so that connection setup (and TLS handshake) happens once per worker lifetime
+    """
+    _connections = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_connection(cls, host, port, ssl_enable):
+        """
+        Get the connection to the server, creating it if needed
+        :return: GeonodeConnection
+        """
+        key = (host, int(port), bool(ssl_enable))
+        with cls._lock:
+            if key not in cls._connections:
+                cls._connections[key] = GeonodeConnection()
+            return cls._connections[key]
+
+    @classmethod
+    def get_stats(cls):
+        """
+        Counters of connects, reconnects and bytes sent for each server
+        :return: dictionary of counters by "host:port"
+        """
+        with cls._lock:
+            return {
+                "{}:{}".format(host, port): pooled.stats
+                for (host, port, _ssl_enable), pooled in cls._connections.items()
+            }
+
+    @classmethod
+    def close_all(cls):
+        """
+        Close all the connections
+        :return: None
+        """
+        with cls._lock:
+            for pooled in cls._connections.values():
+                with pooled.lock:
+                    pooled.close()
+
+
+def get_transport_framing(framing):
+    """
+    Framing of the TCP stream of a CentralizedServer: compressed messages may contain newlines,
+    so they are sent as length-prefixed batches instead of newline-delimited ones
+    :param framing: CentralizedServer.transport_framing
+    :return: framing mode
+    """
+    if GZIP_COMPRESSED and framing == CentralizedServer.FRAMING_NEWLINE:
+        log.warning("Newline-delimited batches require uncompressed messages: length-prefixed batches are used.")
+        return CentralizedServer.FRAMING_LENGTH
+    return framing
+
+
 class GeonodeTcpTransport(TcpTransport):
     """
     Extends TcpTransport to avoid loss of messages
     """
+    DEFAULT_MAX_BATCH_SIZE = 1048576
+    ACK_CHECK_INTERVAL = 0.01
+
+    def __init__(self, *args, **kwargs):
+        self._framing = kwargs.pop('framing', None) or CentralizedServer.FRAMING_NONE
+        self._max_batch_size = kwargs.pop('max_batch_size', None) or self.DEFAULT_MAX_BATCH_SIZE
+        super(GeonodeTcpTransport, self).__init__(*args, **kwargs)
+        self._connection = GeonodeConnectionPool.get_connection(self._host, self._port, self._ssl_enable)
+
+    def send(self, events, use_logging=False):
+        """
+        Super method override to send the events on the pooled keep-alive connection
+        :param events: events to be processed
+        :param use_logging: not used
+        :return: None
+        """
+        with self._connection.lock:
+            self._sock = self._connection.ensure(self._connect)
+            try:
+                with dispatch_instrumentation.time("send"):
+                    self._send(events)
+                dispatch_instrumentation.inc("geonode_logstash_events_sent_total", len(events))
+            except (OSError, ssl.SSLError):
+                # Broken connection: the worker requeues the events, next send reconnects
+                self._connection.close()
+                raise
+            finally:
+                self._sock = None
+
+    def _connect(self):
+        """
+        Open a new connection to the server
+        :return: connected socket
+        """
+        self._sock = None
+        self._create_socket()
+        return self._sock
+
+    def _create_socket(self):
+        """
+        Super method override to verify the certificate of the server with the system CA certificates
+        (and its hostname) when no CA certificates are given
+        :return: None
+        """
+        if not self._ssl_enable or not self._ssl_verify or self._ca_certs:
+            return super(GeonodeTcpTransport, self)._create_socket()
+        if self._sock is not None:
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self._timeout is not TimeoutNotSet:
+            sock.settimeout(self._timeout)
+        try:
+            sock.connect((self._host, self._port))
+            context = ssl.create_default_context()
+            if self._certfile:
+                context.load_cert_chain(self._certfile, self._keyfile)
+            self._sock = context.wrap_socket(sock, server_hostname=self._host)
+        except Exception:
+            sock.close()
+            raise
+
+    def _send_via_socket(self, data):
+        """
+        Super method override to keep track of the bytes sent
+        :param data: event to be sent
+        :return: None
+        """
+        self._connection.sendall(self._convert_data_to_send(data))
+
+    def close(self):
+        """
+        Super method override to close the pooled connection
+        :return: None
+        """
+        with self._connection.lock:
+            self._connection.close()
 
     def _send(self, events):
         """
@@ -685,12 +1947,71 @@ class GeonodeTcpTransport(TcpTransport):
         :param events: events to be processed
         :return: None
         """
+        if self._framing == CentralizedServer.FRAMING_NONE:
+            for event in events:
+                # To avoid loss of messages we need a short sleep, see the following issues:
+                # https://github.com/eht16/python-logstash-async/issues/22
+                # https://github.com/eht16/python-logstash-async/issues/33
+                time.sleep(0.1)
+                self._send_via_socket(event)
+        else:
+            # Framed events can be told apart by the server, so we can send them in batches
+            for batch in self._get_batches(events):
+                self._connection.sendall(batch)
+                self._wait_for_ack()
+
+    def _frame(self, event):
+        """
+        Delimit the event according to the framing mode
+        :param event: event to be framed
+        :return: framed event bytes
+        """
+        data = self._convert_data_to_send(event)
+        if self._framing == CentralizedServer.FRAMING_LENGTH:
+            return struct.pack('>I', len(data)) + data
+        return data if data.endswith(b'\n') else data + b'\n'
+
+    def _get_batches(self, events):
+        """
+        Group the framed events in batches not exceeding the maximum batch size
+        (bigger events are sent alone)
+        :param events: events to be processed
+        :return: generator of batches
+        """
+        batch = []
+        batch_size = 0
         for event in events:
-            # To avoid loss of messages we need a short sleep, see the following issues:
-            # https://github.com/eht16/python-logstash-async/issues/22
-            # https://github.com/eht16/python-logstash-async/issues/33
-            time.sleep(0.1)
-            self._send_via_socket(event)
+            frame = self._frame(event)
+            if batch and batch_size + len(frame) > self._max_batch_size:
+                yield b''.join(batch)
+                batch = []
+                batch_size = 0
+            batch.append(frame)
+            batch_size += len(frame)
+        if batch:
+            yield b''.join(batch)
+
+    def _wait_for_ack(self):
+        """
+        Wait for the server to acknowledge all the bytes sent on the socket.
+        If the timeout expires an exception is raised so that the worker requeues the events.
+        Linux only (see TCP_ACK_SUPPORTED): elsewhere the batches are not waited for.
+        :return: None
+        """
+        if not TCP_ACK_SUPPORTED:
+            return
+        timeout = self._timeout if self._timeout is not TimeoutNotSet else constants.SOCKET_TIMEOUT
+        deadline = time.time() + timeout
+        while True:
+            # Bytes still in the send queue (not sent or not acknowledged yet)
+            unacked = struct.unpack(
+                'i', fcntl.ioctl(self._sock.fileno(), termios.TIOCOUTQ, b'\0\0\0\0')
+            )[0]
+            if unacked == 0:
+                return
+            if time.time() >= deadline:
+                raise socket.timeout("{} bytes not acknowledged by the Logstash server.".format(unacked))
+            time.sleep(self.ACK_CHECK_INTERVAL)
 
 
 class GeonodeLogProcessingWorker(LogProcessingWorker):
@@ -712,37 +2033,184 @@ class GeonodeLogProcessingWorker(LogProcessingWorker):
                 cache=self._memory_cache, event_ttl=self._event_ttl
             )
 
+    def run(self):
+        """
+        Super method override to close the events cache when the worker ends
+        :return: None
+        """
+        try:
+            super(GeonodeLogProcessingWorker, self).run()
+        finally:
+            if isinstance(self._database, GeonodeDatabaseCache):
+                self._database.close()
+
+    def _flush_queued_events(self, force=False):
+        """
+        Super method override to delete the flushed events still pending
+        :param force: flush even if the interval/count has not been reached
+        :return: None
+        """
+        super(GeonodeLogProcessingWorker, self)._flush_queued_events(force=force)
+        if isinstance(self._database, GeonodeDatabaseCache):
+            try:
+                self._database.delete_queued_events(force=True)
+            except DatabaseLockedError:
+                pass  # they will be deleted in a later run
+
     def get_last_queued_event_date(self):
         """
         Get the entry date of the last queued event
         :return: last event entry date
         """
-        query_fetch = "SELECT `entry_date` FROM `event` ORDER BY `entry_date` DESC LIMIT 1;"
+        query_fetch = "SELECT `entry_date` FROM `event` WHERE `pending_delete` = 0 " \
+                      "ORDER BY `entry_date` DESC LIMIT 1;"
         queued_events_dates = self._database.get_from_query(query_fetch)
         if queued_events_dates:
             return queued_events_dates[0]["entry_date"]
 
+    def is_queue_drained(self):
+        """
+        Check if both the internal queue and the events cache are empty. The events being sent are
+        kept in the cache (pending_delete) until they have been delivered
+        :return: True if all the events have been sent
+        """
+        if not self._queue.empty() or self._event is not None:
+            return False
+        if isinstance(self._database, GeonodeDatabaseCache):
+            return not self._database.has_events()
+        return not self._database._cache
+
 
 class GeonodeDatabaseCache(DatabaseCache):
     """
-    Extends DatabaseCache to have more method
+    Extends DatabaseCache to have more method.
+    A single WAL-mode connection is kept open (shared by the worker and the dispatcher threads),
+    so that SQLite can reuse its prepared statements, and the flushed events are deleted in batches.
     """
+    DELETE_BATCH_SIZE = 1000
+    SCHEMA_STATEMENTS = [
+        """CREATE INDEX IF NOT EXISTS `idx_entry_date` ON `event` (entry_date);""",
+        """CREATE INDEX IF NOT EXISTS `idx_pending_delete_entry_date` ON `event` (pending_delete, entry_date);""",
+    ]
+
+    def __init__(self, *args, **kwargs):
+        super(GeonodeDatabaseCache, self).__init__(*args, **kwargs)
+        self._lock = threading.RLock()
+        self._pending_deletes = 0
+
+    @contextmanager
+    def _connect(self):
+        """
+        Super method override to keep the connection open
+        :return: connection
+        """
+        with self._lock:
+            if self._connection is None:
+                self._open()
+            try:
+                with self._connection as connection:
+                    yield connection
+            except sqlite3.OperationalError:
+                self._handle_sqlite_error()
+                raise
+
+    def _open(self):
+        """
+        Super method override to share the connection between threads and enable WAL mode
+        :return: None
+        """
+        self._connection = sqlite3.connect(
+            self._database_path,
+            timeout=constants.DATABASE_TIMEOUT,
+            isolation_level='EXCLUSIVE',
+            check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL;')
+        self._connection.execute('PRAGMA synchronous=NORMAL;')
+        self._initialize_schema()
+
+    def _initialize_schema(self):
+        """
+        Super method override to add the indexes used by the Geonode queries
+        :return: None
+        """
+        super(GeonodeDatabaseCache, self)._initialize_schema()
+        cursor = self._connection.cursor()
+        try:
+            for statement in self.SCHEMA_STATEMENTS:
+                cursor.execute(statement)
+        except sqlite3.OperationalError:
+            self._close()
+            self._handle_sqlite_error()
+            raise
+
+    def get_queued_events(self):
+        """
+        Super method override to keep track of the events to be deleted
+        :return: events
+        """
+        with dispatch_instrumentation.time("flush"):
+            events = super(GeonodeDatabaseCache, self).get_queued_events()
+        self._pending_deletes += len(events)
+        return events
+
+    def requeue_queued_events(self, events):
+        """
+        Super method override to keep track of the events to be deleted
+        :param events: events to be requeued
+        :return: None
+        """
+        super(GeonodeDatabaseCache, self).requeue_queued_events(events)
+        self._pending_deletes = max(self._pending_deletes - len(events), 0)
+
+    def delete_queued_events(self, force=False):
+        """
+        Super method override to delete the flushed events in batches
+        :param force: delete the flushed events even if the batch is not full
+        :return: None
+        """
+        if self._pending_deletes and (force or self._pending_deletes >= self.DELETE_BATCH_SIZE):
+            with dispatch_instrumentation.time("flush"):
+                super(GeonodeDatabaseCache, self).delete_queued_events()
+            self._pending_deletes = 0
 
-    def get_from_query(self, query_fetch):
+    def has_events(self):
+        """
+        Check if the cache holds events, either queued or being sent (pending_delete)
+        :return: True if there are events
+        """
+        return bool(self.get_from_query("SELECT 1 FROM `event` LIMIT 1;"))
+
+    def close(self):
+        """
+        Close the connection
+        :return: None
+        """
+        with self._lock:
+            self._close()
+
+    def get_from_query(self, query_fetch, params=()):
         """
         Method to execute query and retrieve results
         :return: query results
         """
         with self._connect() as connection:
             cursor = connection.cursor()
-            cursor.execute(query_fetch)
+            cursor.execute(query_fetch, params)
             results = cursor.fetchall()
         return results
 
 
-constants.SOCKET_TIMEOUT = LogstashDispatcher.get_socket_timeout()
-constants.QUEUE_CHECK_INTERVAL = LogstashDispatcher.get_queue_check_interval()
-constants.QUEUED_EVENTS_FLUSH_INTERVAL = LogstashDispatcher.get_queue_events_flush_interval()
-constants.QUEUED_EVENTS_FLUSH_COUNT = LogstashDispatcher.get_queue_events_flush_count()
-constants.QUEUED_EVENTS_BATCH_SIZE = LogstashDispatcher.get_queue_events_batch_size()
-constants.DATABASE_TIMEOUT = LogstashDispatcher.get_logstash_db_timeout()
+def invalidate_centralized_server_config(sender, **kwargs):
+    """
+    Clear the cached configuration when the CentralizedServer changes
+    """
+    update_fields = kwargs.get("update_fields")
+    # Delivery timestamps updated by the dispatcher do not affect the configuration
+    if update_fields and not set(update_fields) & {field for _name, field in CONSTANTS_FIELDS}:
+        return
+    LogstashDispatcher.invalidate_config()
+
+
+signals.post_save.connect(invalidate_centralized_server_config, sender=CentralizedServer)
+signals.post_delete.connect(invalidate_centralized_server_config, sender=CentralizedServer)
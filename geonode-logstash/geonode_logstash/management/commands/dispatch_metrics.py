@@ -20,12 +20,25 @@
 
 from __future__ import print_function
 from django.core.management.base import BaseCommand
-from ...logstash import LogstashDispatcher
 
 
 class Command(BaseCommand):
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profile',
+            action='store_true',
+            default=False,
+            help="Print the duration of each dispatch stage (Prometheus text format)"
+        )
+
     def handle(self, *args, **kwargs):
-        ld = LogstashDispatcher()
+        from ...logstash import get_dispatcher
+        from ...instrumentation import dispatch_instrumentation
+        if kwargs.get('profile'):
+            dispatch_instrumentation.reset()
+        ld = get_dispatcher()
         ld.dispatch_metrics()
+        if kwargs.get('profile'):
+            self.stdout.write(dispatch_instrumentation.render())
 
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.13 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geonode_logstash', '0003_auto_20200608_1143'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='centralizedserver',
+            name='transport_framing',
+            field=models.CharField(choices=[('none', 'No framing (one event every 100 ms)'), ('newline', 'Newline-delimited batches'), ('length', 'Length-prefixed batches')], default='none', help_text='How events are delimited on the TCP stream. Framed batches are sent without any delay between events; newline-delimited batches require uncompressed messages.', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='centralizedserver',
+            name='transport_max_batch_size',
+            field=models.IntegerField(blank=True, default=1048576, help_text='Maximum size in bytes of a framed batch of events sent to Logstash.', null=True),
+        ),
+    ]
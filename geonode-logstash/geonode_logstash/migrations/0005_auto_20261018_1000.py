@@ -0,0 +1,23 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geonode_logstash', '0004_auto_20261018_0900'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='centralizedserver',
+            name='compression',
+            field=models.CharField(choices=[('gzip', 'gzip'), ('zstd', 'zstd (requires the zstandard package)')], default='gzip', help_text='Compression method of the messages, used when USER_ANALYTICS_GZIP is enabled.', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='centralizedserver',
+            name='compression_level',
+            field=models.IntegerField(blank=True, help_text='Compression level (1-9 for gzip, 1-22 for zstd). If empty 9 is used for gzip and 3 for zstd.', null=True),
+        ),
+    ]
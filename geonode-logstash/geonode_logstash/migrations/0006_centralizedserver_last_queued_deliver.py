@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geonode_logstash', '0005_auto_20261018_1000'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='centralizedserver',
+            name='last_queued_deliver',
+            field=models.DateTimeField(blank=True, help_text='End of the last time window queued for delivery (its events are cached locally until they are delivered).', null=True),
+        ),
+    ]
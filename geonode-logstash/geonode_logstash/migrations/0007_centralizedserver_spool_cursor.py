@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geonode_logstash', '0006_centralizedserver_last_queued_deliver'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='centralizedserver',
+            name='spool_cursor',
+            field=models.BigIntegerField(blank=True, help_text='Last time window of the local spool delivered to the server (used when USER_ANALYTICS_SPOOL_DISPATCH is enabled).', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geonode_logstash', '0007_centralizedserver_spool_cursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='centralizedserver',
+            name='ssl_enable',
+            field=models.BooleanField(default=False, help_text='Whether the connection to Logstash uses SSL/TLS (the certificate of the server is verified).'),
+        ),
+    ]
@@ -18,6 +18,7 @@
 #
 #########################################################################
 import uuid
+from types import MappingProxyType
 from django.db import models
 from django.conf import settings
 from django.utils.translation import ugettext_noop as _
@@ -1980,12 +1981,33 @@ COUNTRIES_GEODB = [
     }
 ]
 
+# ISO-3 -> center = (Lat, Lon) index of COUNTRIES_GEODB, built once at import
+COUNTRIES_CENTERS = MappingProxyType({
+    _cnt["country.iso_3"]: tuple(float(i) for i in _cnt["country.center"])
+    for _cnt in COUNTRIES_GEODB
+})
+
 
 class CentralizedServer(models.Model):
 
     """
     Centralized Server for monitoring/analytics metrics data
     """
+    FRAMING_NONE = 'none'
+    FRAMING_NEWLINE = 'newline'
+    FRAMING_LENGTH = 'length'
+    TRANSPORT_FRAMINGS = (
+        (FRAMING_NONE, _("No framing (one event every 100 ms)")),
+        (FRAMING_NEWLINE, _("Newline-delimited batches")),
+        (FRAMING_LENGTH, _("Length-prefixed batches")),
+    )
+    COMPRESSION_GZIP = 'gzip'
+    COMPRESSION_ZSTD = 'zstd'
+    COMPRESSIONS = (
+        (COMPRESSION_GZIP, _("gzip")),
+        (COMPRESSION_ZSTD, _("zstd (requires the zstandard package)")),
+    )
+
     host = models.CharField(
         max_length=255,
         null=False,
@@ -2058,6 +2080,39 @@ class CentralizedServer(models.Model):
         default=5.0,
         help_text=_("Timeout in seconds to 'connect' the SQLite database.")
     )
+    transport_framing = models.CharField(
+        max_length=16,
+        null=False,
+        blank=False,
+        choices=TRANSPORT_FRAMINGS,
+        default=FRAMING_NONE,
+        help_text=_("How events are delimited on the TCP stream. Framed batches are sent without "
+                    "any delay between events; newline-delimited batches require uncompressed messages.")
+    )
+    transport_max_batch_size = models.IntegerField(
+        null=True,
+        blank=True,
+        default=1048576,
+        help_text=_("Maximum size in bytes of a framed batch of events sent to Logstash.")
+    )
+    ssl_enable = models.BooleanField(
+        default=False,
+        help_text=_("Whether the connection to Logstash uses SSL/TLS (the certificate of the server is verified).")
+    )
+    compression = models.CharField(
+        max_length=16,
+        null=False,
+        blank=False,
+        choices=COMPRESSIONS,
+        default=COMPRESSION_GZIP,
+        help_text=_("Compression method of the messages, used when USER_ANALYTICS_GZIP is enabled.")
+    )
+    compression_level = models.IntegerField(
+        null=True,
+        blank=True,
+        help_text=_("Compression level (1-9 for gzip, 1-22 for zstd). "
+                    "If empty 9 is used for gzip and 3 for zstd.")
+    )
     last_successful_deliver = models.DateTimeField(
         null=True,
         blank=True,
@@ -2073,6 +2128,18 @@ class CentralizedServer(models.Model):
         blank=True,
         help_text=_("Timestamp of the last failed deliver.")
     )
+    last_queued_deliver = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text=_("End of the last time window queued for delivery "
+                    "(its events are cached locally until they are delivered).")
+    )
+    spool_cursor = models.BigIntegerField(
+        null=True,
+        blank=True,
+        help_text=_("Last time window of the local spool delivered to the server "
+                    "(used when USER_ANALYTICS_SPOOL_DISPATCH is enabled).")
+    )
 
     def save(self, *args, **kwargs):
         """
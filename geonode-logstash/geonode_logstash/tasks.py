@@ -19,7 +19,6 @@
 #########################################################################
 
 from celery import shared_task
-from geonode_logstash.logstash import LogstashDispatcher
 
 
 @shared_task
@@ -27,5 +26,7 @@ def dispatch_metrics():
     """
     Send metrics data to the centralized logstash server
     """
-    ld = LogstashDispatcher()
+    # Loaded on the first dispatch: the worker and the web processes do not pay its import cost
+    from geonode_logstash.logstash import get_dispatcher
+    ld = get_dispatcher()
     ld.dispatch_metrics()
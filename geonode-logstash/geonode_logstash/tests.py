@@ -18,15 +18,46 @@
 #
 #########################################################################
 
+import os
+import sys
+import json
+import gzip
+import time
+import tempfile
+import struct
+import socket
 import logging
+import threading
 import datetime
 import pytz
 import binascii
+import subprocess
+from contextlib import contextmanager
+from functools import partial
+from types import SimpleNamespace
 from geonode.tests.base import GeoNodeBaseTestSupport
+from django.test import SimpleTestCase
 from django.test.utils import override_settings
 from django.core.management import call_command
+from django.db.models import signals
 from geonode_logstash.models import CentralizedServer
-from geonode_logstash.logstash import LogstashDispatcher
+from geonode.monitoring.models import EventType
+from geonode_logstash import logstash
+from geonode_logstash.instrumentation import DispatchInstrumentation, dispatch_instrumentation
+from geonode_logstash.logstash import (
+    constants,
+    CONSTANTS_DEFAULTS,
+    DATA_TYPES_MAP,
+    LogstashDispatcher,
+    LogstashSpoolDispatcher,
+    GeonodeMetricSpool,
+    GeonodeTcpTransport,
+    GeonodeConnectionPool,
+    GeonodeLogstashFormatter,
+    GeonodeLogstashSerializer,
+    GeonodeDatabaseCache,
+    GeonodeAsynchronousLogstashHandler
+)
 # from django_celery_beat.models import PeriodicTask, IntervalSchedul
 
 logger = logging.getLogger(__name__)
@@ -180,3 +211,835 @@ class GeonodeLogstashTest(GeoNodeBaseTestSupport):
         formatter = ld._handler.formatter
         compressed = formatter.json_gzip(msg)
         self.assertTrue(binascii.hexlify(compressed), b'1f8b')
+
+    @override_settings(MONITORING_ENABLED=True, USER_ANALYTICS_ENABLED=True, USER_ANALYTICS_GZIP=True)
+    def test_grouped_metrics_data(self):
+        ld = LogstashDispatcher()
+        ld._valid_from = self._valid_from
+        ld._valid_to = self._valid_to
+        resources = [dt for dt in DATA_TYPES_MAP if dt["name"] == "resources"][0]
+        families_data = ld._get_families_data(resources)
+        for idx, metric in enumerate(resources["metrics"]):
+            if idx not in families_data:
+                continue
+            event_type = metric["params"].get("event_type")
+            metrics_data = ld._collector.get_metrics_data(
+                metric_name=metric["name"],
+                valid_from=ld._valid_from,
+                valid_to=ld._valid_to,
+                interval=ld._interval,
+                event_type=EventType.get(event_type) if event_type else None,
+                group_by=metric["params"]["group_by"]
+            )
+            # Same groups (label, user and resource) and values of CollectorAPI
+            self.assertEqual(
+                sorted((m["label"], m["user"], m["resource"]["id"], int(m["val"])) for m in metrics_data),
+                sorted((m["label"], m["user"], m["resource"]["id"], int(m["val"])) for m in families_data[idx])
+            )
+
+
+class FakeCollectorAPI(object):
+    """
+    CollectorAPI stand-in returning synthetic metric rows
+    """
+
+    def __init__(self, rows_count):
+        self.rows = [
+            {
+                "label": "label_{}".format(i),
+                "val": rows_count - i,
+                "resource": {
+                    "name": "geonode:layer_{}".format(i),
+                    "type": "layer",
+                    "href": "/layers/geonode:layer_{}".format(i)
+                }
+            }
+            for i in range(rows_count)
+        ]
+
+    def get_metrics_data(self, *args, **kwargs):
+        return self.rows
+
+
+class GeonodeLogstashBenchmarkTest(SimpleTestCase):
+    """
+    Micro-benchmarks of the geonode_logstash message building.
+    """
+    rows_count = 50000
+    data_type = {
+        "name": "resources",
+        "metrics": [
+            {
+                "name": "request.count",
+                "params": {
+                    "group_by": "resource_on_label"
+                },
+                "hooks": {
+                    "name": "resource.name",
+                    "type": "resource.type",
+                    "url": "resource.href",
+                    "hits": "val"
+                }
+            },
+            {
+                "name": "request.users",
+                "params": {
+                    "group_by": "resource_on_user"
+                },
+                "hooks": {
+                    "name": "resource.name",
+                    "unique_visitors": "val"
+                }
+            }
+        ]
+    }
+
+    def setUp(self):
+        self.ld = LogstashDispatcher.__new__(LogstashDispatcher)
+        self.ld._collector = FakeCollectorAPI(self.rows_count)
+        self.ld.client_ip = "127.0.0.1"
+        self.ld._valid_to = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        self.ld._valid_from = self.ld._valid_to - datetime.timedelta(seconds=3600)
+        self.ld._interval = 3600
+
+    @override_settings(HOSTNAME="localhost")
+    def test_get_message_list_merge(self):
+        start = time.time()
+        msg = self.ld._get_message(self.data_type)
+        elapsed = time.time() - start
+        logger.info("Built message of {} resources in {:.3f}s".format(self.rows_count, elapsed))
+        self.assertEqual(len(msg["resources"]), self.rows_count)
+        self.assertEqual(msg["resources"][0], {
+            "name": "geonode:layer_0",
+            "type": "layer",
+            "url": "/layers/geonode:layer_0",
+            "hits": self.rows_count,
+            "unique_visitors": self.rows_count
+        })
+        # The quadratic merge took minutes with this amount of rows
+        self.assertLess(elapsed, 10)
+
+    def test_set_countries_center(self):
+        countries = [{"name": "ITA", "hits": 2}, {"name": "XXX", "hits": 1}, {"name": "ITA", "hits": 1}]
+        LogstashDispatcher._set_countries_center(countries)
+        self.assertEqual(countries[0]["center"], [42.6384261, 12.674297])
+        self.assertNotIn("center", countries[1])
+        self.assertEqual(countries[2]["center"], countries[0]["center"])
+
+
+class FakeCursor(object):
+    """
+    DB cursor stand-in recording the executed queries and returning a single row
+    """
+
+    def __init__(self, queries, row):
+        self.queries = queries
+        self.row = row
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+        self.description = [(col,) for col in self.row]
+
+    def fetchone(self):
+        return tuple(self.row.values())
+
+
+class GeonodeLogstashExtrasTest(SimpleTestCase):
+    """
+    Test the single query of the "extra" overview fields.
+    """
+
+    def setUp(self):
+        self.queries = []
+        self.connection = logstash.connection
+        self.transaction = logstash.transaction
+        row = {"registered_users": 3, "layers": 2, "maps": 1, "documents": 0, "errors": 5}
+        logstash.connection = SimpleNamespace(
+            ops=self.connection.ops, cursor=lambda: FakeCursor(self.queries, row)
+        )
+        logstash.transaction = SimpleNamespace(atomic=self._atomic)
+        LogstashDispatcher._exact_counts_time = None
+        self.ld = LogstashDispatcher.__new__(LogstashDispatcher)
+        self.ld._valid_to = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        self.ld._valid_from = self.ld._valid_to - datetime.timedelta(seconds=3600)
+        self.ld._get_custom = lambda: "custom"
+
+    def tearDown(self):
+        logstash.connection = self.connection
+        logstash.transaction = self.transaction
+        LogstashDispatcher._exact_counts_time = None
+
+    @staticmethod
+    @contextmanager
+    def _atomic():
+        yield
+
+    def test_extras(self):
+        extras = ["registered_users", "layers", "documents", "maps", "errors", "custom"]
+        expected = {"registered_users": 3, "layers": 2, "documents": 0, "maps": 1, "errors": 5, "custom": "custom"}
+        self.assertEqual(self.ld._get_extras(extras), expected)
+        self.assertEqual(len(self.queries), 1)
+        self.assertNotIn("reltuples", self.queries[0][0])
+        # Exact counts have been just refreshed: large tables are estimated
+        self.assertEqual(self.ld._get_extras(extras), expected)
+        self.assertEqual(len(self.queries), 2)
+        self.assertIn("reltuples", self.queries[1][0])
+        self.assertEqual(self.queries[1][1]["layers_table"], "layers_layer")
+
+
+class LogstashTcpSink(object):
+    """
+    Local TCP stand-in for the Logstash server counting the received events
+    """
+
+    def __init__(self, framing):
+        self.framing = framing
+        self.events = []
+        self.connections = 0
+        self._conn = None
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(5)
+        self.host, self.port = self._sock.getsockname()
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _addr = self._sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            self._conn = conn
+            with conn:
+                buffer = b""
+                while True:
+                    try:
+                        chunk = conn.recv(65536)
+                    except OSError:
+                        break
+                    if not chunk:
+                        break
+                    buffer += chunk
+                    buffer = self._parse(buffer)
+
+    def _parse(self, buffer):
+        if self.framing == CentralizedServer.FRAMING_LENGTH:
+            while len(buffer) >= 4:
+                size = struct.unpack(">I", buffer[:4])[0]
+                if len(buffer) < 4 + size:
+                    break
+                self.events.append(buffer[4:4 + size])
+                buffer = buffer[4 + size:]
+        else:
+            *events, buffer = buffer.split(b"\n")
+            self.events.extend(events)
+        return buffer
+
+    def wait_for_events(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.events) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return len(self.events)
+
+    def drop_connection(self):
+        self._conn.shutdown(socket.SHUT_RDWR)
+
+    def close(self):
+        self._sock.close()
+
+
+class GeonodeTcpTransportTest(SimpleTestCase):
+    """
+    Test the framed batches of GeonodeTcpTransport.
+    """
+    events_count = 1000
+
+    def _get_transport(self, sink, framing, max_batch_size=None):
+        transport = GeonodeTcpTransport(
+            sink.host, sink.port, ssl_enable=False, ssl_verify=False, keyfile=None,
+            certfile=None, ca_certs=None, timeout=5.0, framing=framing,
+            max_batch_size=max_batch_size
+        )
+        self.addCleanup(transport.close)
+        return transport
+
+    def _send_events(self, framing, max_batch_size=None):
+        sink = LogstashTcpSink(framing)
+        self.addCleanup(sink.close)
+        transport = self._get_transport(sink, framing, max_batch_size)
+        events = ['{{"event": {}}}'.format(i) for i in range(self.events_count)]
+        start = time.time()
+        transport.send(events)
+        elapsed = time.time() - start
+        self.assertEqual(sink.wait_for_events(self.events_count), self.events_count)
+        self.assertEqual(sink.events, [e.encode("utf-8") for e in events])
+        # Without framing it takes 100 ms per event
+        self.assertLess(elapsed, self.events_count * 0.1 / 10)
+
+    def test_newline_framing(self):
+        self._send_events(CentralizedServer.FRAMING_NEWLINE)
+
+    def test_length_framing(self):
+        self._send_events(CentralizedServer.FRAMING_LENGTH)
+
+    def test_compressed_framing(self):
+        gzip_compressed = logstash.GZIP_COMPRESSED
+        self.addCleanup(setattr, logstash, "GZIP_COMPRESSED", gzip_compressed)
+        logstash.GZIP_COMPRESSED = True
+        # Compressed messages may contain newlines
+        self.assertEqual(
+            logstash.get_transport_framing(CentralizedServer.FRAMING_NEWLINE), CentralizedServer.FRAMING_LENGTH
+        )
+        self.assertEqual(logstash.get_transport_framing(CentralizedServer.FRAMING_NONE), CentralizedServer.FRAMING_NONE)
+        logstash.GZIP_COMPRESSED = False
+        self.assertEqual(
+            logstash.get_transport_framing(CentralizedServer.FRAMING_NEWLINE), CentralizedServer.FRAMING_NEWLINE
+        )
+
+    def test_max_batch_size(self):
+        self._send_events(CentralizedServer.FRAMING_LENGTH, max_batch_size=256)
+        transport = GeonodeTcpTransport(
+            "127.0.0.1", 0, ssl_enable=False, ssl_verify=False, keyfile=None,
+            certfile=None, ca_certs=None, framing=CentralizedServer.FRAMING_NEWLINE,
+            max_batch_size=10
+        )
+        batches = list(transport._get_batches(["12345", "12345", "1234567890123"]))
+        self.assertEqual(batches, [b"12345\n", b"12345\n", b"1234567890123\n"])
+
+    def test_connection_pool(self):
+        framing = CentralizedServer.FRAMING_NEWLINE
+        sink = LogstashTcpSink(framing)
+        self.addCleanup(sink.close)
+        transport = self._get_transport(sink, framing)
+        transport.send(["first"])
+        # A new transport to the same server reuses the connection
+        self._get_transport(sink, framing).send(["second"])
+        self.assertEqual(sink.wait_for_events(2), 2)
+        stats = GeonodeConnectionPool.get_stats()["{}:{}".format(sink.host, sink.port)]
+        self.assertEqual(stats["connects"], 1)
+        self.assertEqual(stats["reconnects"], 0)
+        self.assertEqual(stats["bytes_sent"], len(b"first\nsecond\n"))
+        # The health check detects the connection closed by the server
+        sink.drop_connection()
+        time.sleep(0.1)
+        transport.send(["third"])
+        self.assertEqual(sink.wait_for_events(3), 3)
+        self.assertEqual(sink.connections, 2)
+        stats = GeonodeConnectionPool.get_stats()["{}:{}".format(sink.host, sink.port)]
+        self.assertEqual(stats["connects"], 2)
+        self.assertEqual(stats["reconnects"], 1)
+
+    def test_test_dispatch(self):
+        framing = CentralizedServer.FRAMING_LENGTH
+        sink = LogstashTcpSink(framing)
+        self.addCleanup(sink.close)
+        ld = LogstashDispatcher.__new__(LogstashDispatcher)
+        ld._centralized_server = SimpleNamespace(host=sink.host, port=sink.port, ssl_enable=False)
+        ld._transport_factory = partial(GeonodeTcpTransport, framing=framing)
+        ld._handler = SimpleNamespace(
+            formatter=GeonodeLogstashFormatter(gzip=True, compression=CentralizedServer.COMPRESSION_GZIP)
+        )
+        ld.client_ip = "127.0.0.1"
+        ld.test_dispatch()
+        self.assertEqual(sink.wait_for_events(1), 1)
+        self.assertEqual(json.loads(gzip.decompress(sink.events[0]).decode("utf-8"))["test"], "test")
+        # The connection to the test host is not left open
+        self.assertEqual(GeonodeConnectionPool.get_stats()["{}:{}".format(sink.host, sink.port)]["connected"], False)
+        # A message which cannot be compressed is an error, not a TypeError
+        ld._handler.formatter.json_gzip = lambda data: None
+        with self.assertRaises(ValueError):
+            ld.test_dispatch()
+
+
+class FakeCentralizedServer(SimpleNamespace):
+    """
+    CentralizedServer stand-in keeping the delivery state in memory
+    """
+
+    def save(self, update_fields=None):
+        self.saved_fields = update_fields
+
+
+class LogstashSpoolDispatcherTest(SimpleTestCase):
+    """
+    Test the delivery of the spooled payloads to several servers.
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.spool = GeonodeMetricSpool(os.path.join(tmp_dir, "spool.db"))
+        self.addCleanup(self.spool.close)
+        self.sink = LogstashTcpSink(CentralizedServer.FRAMING_NEWLINE)
+        self.addCleanup(self.sink.close)
+        # Nothing listening on the port of the second server
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(("127.0.0.1", 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+        self.servers = [
+            self._get_server(self.sink.host, self.sink.port),
+            self._get_server("127.0.0.1", closed_port)
+        ]
+        self.ld = LogstashSpoolDispatcher.__new__(LogstashSpoolDispatcher)
+        self.ld._spool = self.spool
+        self.ld._serializer = GeonodeLogstashSerializer()
+        self.ld._servers = self.servers
+        self.ld._centralized_server = self.servers[0]
+
+    def _get_server(self, host, port):
+        return FakeCentralizedServer(
+            host=host, port=port, interval=3600, socket_timeout=1.0,
+            transport_framing=CentralizedServer.FRAMING_NEWLINE, transport_max_batch_size=None,
+            compression=CentralizedServer.COMPRESSION_GZIP, compression_level=None,
+            spool_cursor=0, last_successful_deliver=None, last_failed_deliver=None,
+            next_scheduled_deliver=None
+        )
+
+    def _spool_window(self, valid_to, messages):
+        self.ld._valid_to = valid_to
+        self.ld._valid_from = valid_to - datetime.timedelta(seconds=3600)
+        self.ld._spool_messages(messages)
+
+    def test_fan_out(self):
+        valid_to = datetime.datetime(2026, 10, 18, 10, tzinfo=pytz.utc)
+        self._spool_window(valid_to, [{"window": 1, "type": "overview"}, {"window": 1, "type": "countries"}])
+        self._spool_window(valid_to + datetime.timedelta(hours=1), [])
+        self.assertEqual(self.ld._get_watermark(), valid_to + datetime.timedelta(hours=1))
+        self.ld._fan_out()
+        self.assertEqual(self.sink.wait_for_events(2), 2)
+        self.assertEqual(json.loads(self.sink.events[1].decode("utf-8")), {"window": 1, "type": "countries"})
+        reachable, unreachable = self.servers
+        self.assertEqual(reachable.spool_cursor, 2)
+        self.assertEqual(reachable.last_successful_deliver, valid_to + datetime.timedelta(hours=1))
+        self.assertIsNone(reachable.last_failed_deliver)
+        # The unreachable server will retry from its cursor
+        self.assertEqual(unreachable.spool_cursor, 0)
+        self.assertIsNotNone(unreachable.last_failed_deliver)
+        self.assertEqual(len(self.spool.get_windows(unreachable.spool_cursor)), 2)
+        # Once both servers have delivered the windows, the payloads are pruned
+        unreachable.port = self.sink.port
+        self.ld._fan_out()
+        self.assertEqual(self.sink.wait_for_events(4), 4)
+        self.assertEqual(unreachable.spool_cursor, 2)
+        self.assertEqual(self.spool.get_payloads(1), [])
+        self.assertEqual(self.spool.get_last_valid_to(), valid_to + datetime.timedelta(hours=1))
+
+
+class GeonodeLogstashPipelineBenchmarkTest(SimpleTestCase):
+    """
+    Benchmark of the dispatch stages: message build from a fake CollectorAPI,
+    serialization, compression and transport to a local TCP sink.
+    """
+    rows_count = 5000
+    messages_count = 200
+
+    def setUp(self):
+        dispatch_instrumentation.reset()
+        self.addCleanup(dispatch_instrumentation.reset)
+        self.ld = LogstashDispatcher.__new__(LogstashDispatcher)
+        self.ld._collector = FakeCollectorAPI(self.rows_count)
+        self.ld.client_ip = "127.0.0.1"
+        self.ld._valid_to = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        self.ld._valid_from = self.ld._valid_to - datetime.timedelta(seconds=3600)
+        self.ld._interval = 3600
+
+    def _get_rate(self, stage, count):
+        _count, seconds = dispatch_instrumentation.get_histogram(stage)
+        return count / seconds if seconds else float("inf")
+
+    @override_settings(HOSTNAME="localhost")
+    def test_pipeline(self):
+        framing = CentralizedServer.FRAMING_LENGTH
+        sink = LogstashTcpSink(framing)
+        self.addCleanup(sink.close)
+        transport = GeonodeTcpTransport(
+            sink.host, sink.port, ssl_enable=False, ssl_verify=False, keyfile=None,
+            certfile=None, ca_certs=None, timeout=5.0, framing=framing
+        )
+        self.addCleanup(transport.close)
+        formatter = GeonodeLogstashFormatter(gzip=True, compression=CentralizedServer.COMPRESSION_GZIP)
+        msg = self.ld._get_message(GeonodeLogstashBenchmarkTest.data_type)
+        payloads = [formatter.json_gzip(msg) for _i in range(self.messages_count)]
+        transport.send(payloads)
+        self.assertEqual(sink.wait_for_events(self.messages_count, timeout=30), self.messages_count)
+        for stage in ("query", "build", "serialize", "compress", "send"):
+            self.assertGreater(dispatch_instrumentation.get_histogram(stage)[0], 0)
+        self.assertEqual(
+            dispatch_instrumentation.get_counter("geonode_logstash_events_sent_total"), self.messages_count
+        )
+        raw_bytes = dispatch_instrumentation.get_counter("geonode_logstash_bytes_total", stage="serialize")
+        logger.info(
+            "Build {:.0f} rows/s, serialize {:.0f} msg/s, compress {:.1f} MB/s, send {:.1f} MB/s".format(
+                self._get_rate("build", self.rows_count * 2),
+                self._get_rate("serialize", self.messages_count),
+                self._get_rate("compress", raw_bytes / 1048576.0),
+                self._get_rate("send", sum(len(p) for p in payloads) / 1048576.0)
+            )
+        )
+
+    def test_render(self):
+        instrumentation = DispatchInstrumentation(buckets=(0.1, 1.0))
+        instrumentation.observe("send", 0.05)
+        instrumentation.observe("send", 0.5)
+        instrumentation.inc("geonode_logstash_bytes_total", 10, stage="compress")
+        text = instrumentation.render()
+        self.assertIn('geonode_logstash_stage_duration_seconds_bucket{stage="send",le="0.1"} 1', text)
+        self.assertIn('geonode_logstash_stage_duration_seconds_bucket{stage="send",le="+Inf"} 2', text)
+        self.assertIn('geonode_logstash_stage_duration_seconds_count{stage="send"} 2', text)
+        self.assertIn('geonode_logstash_bytes_total{stage="compress"} 10', text)
+
+
+class GeonodeLogstashFormatterTest(SimpleTestCase):
+    """
+    Test the compression of the messages.
+    """
+    message = {
+        "format_version": "1.0",
+        "data_type": "resources",
+        "resources": [{"name": "geonode:layer_{}".format(i), "hits": i} for i in range(100)]
+    }
+
+    def test_gzip_compressor_reuse(self):
+        for level in (None, 1, 6):
+            formatter = GeonodeLogstashFormatter(
+                gzip=True, compression=CentralizedServer.COMPRESSION_GZIP, compression_level=level
+            )
+            for _i in range(3):
+                compressed = formatter.json_gzip(self.message)
+                self.assertEqual(binascii.hexlify(compressed[:2]), b"1f8b")
+                self.assertEqual(json.loads(gzip.decompress(compressed)), self.message)
+
+    def test_zstd_compressor(self):
+        try:
+            import zstandard
+        except ImportError:
+            self.skipTest("zstandard is not installed")
+        formatter = GeonodeLogstashFormatter(gzip=True, compression=CentralizedServer.COMPRESSION_ZSTD)
+        for _i in range(3):
+            compressed = formatter.json_gzip(self.message)
+            self.assertEqual(
+                json.loads(zstandard.ZstdDecompressor().decompress(compressed)), self.message
+            )
+
+
+class GeonodeLogstashSerializerTest(SimpleTestCase):
+    """
+    Test the JSON serializer backends.
+    """
+    message = {
+        "format_version": "1.0",
+        "data_type": "resources",
+        "instance": {"name": "localhost", "ip": "127.0.0.1"},
+        "time": {"startTime": "2026-10-18T09:00:00+00:00", "endTime": "2026-10-18T10:00:00+00:00"},
+        "resources": [
+            {"name": "geonode:layer_{}".format(i), "type": "layer", "url": "/layers/geonode:layer_{}".format(i),
+             "hits": i, "unique_visitors": i}
+            for i in range(50000)
+        ]
+    }
+
+    def test_backends(self):
+        for backend in GeonodeLogstashSerializer.BACKENDS:
+            serializer = GeonodeLogstashSerializer(backend=backend)
+            start = time.time()
+            serialized = serializer.dumps_message(self.message)
+            logger.info("{} serialized 50k resources in {:.3f}s".format(serializer.backend, time.time() - start))
+            self.assertIsInstance(serialized, bytes)
+            self.assertEqual(json.loads(serialized.decode("utf-8")), self.message)
+            # The cached header fragment gives the same output
+            self.assertEqual(serializer.dumps_message(self.message), serialized)
+            self.assertEqual(len(serializer._headers), 1)
+
+    def test_fallback(self):
+        serializer = GeonodeLogstashSerializer()
+        # Not serializable by the fast backends nor by the stdlib
+        with self.assertRaises(TypeError):
+            serializer.dumps({"value": object()})
+        self.assertEqual(json.loads(serializer.dumps_message({"format_version": "1.0"})), {"format_version": "1.0"})
+
+
+class GeonodeDatabaseCacheTest(SimpleTestCase):
+    """
+    Test the SQLite events cache.
+    """
+    events_count = 100000
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.cache = GeonodeDatabaseCache(path=os.path.join(self.tmp_dir.name, "logstash.db"))
+        self.addCleanup(self.cache.close)
+
+    def test_wal_mode_and_indexes(self):
+        journal_mode = self.cache.get_from_query("PRAGMA journal_mode;")[0][0]
+        self.assertEqual(journal_mode, "wal")
+        indexes = [
+            row["name"] for row in self.cache.get_from_query(
+                "SELECT `name` FROM `sqlite_master` WHERE `type` = 'index' AND `tbl_name` = ?;", ("event",)
+            )
+        ]
+        self.assertIn("idx_entry_date", indexes)
+        self.assertIn("idx_pending_delete_entry_date", indexes)
+
+    def test_drain_backlog(self):
+        with self.cache._connect() as connection:
+            connection.executemany(
+                "INSERT INTO `event` (`event_text`, `pending_delete`, `entry_date`) "
+                "VALUES (?, 0, datetime('now'));",
+                (("event {}".format(i),) for i in range(self.events_count))
+            )
+        start = time.time()
+        sent = 0
+        while True:
+            events = self.cache.get_queued_events()
+            if not events:
+                break
+            sent += len(events)
+            self.cache.delete_queued_events()
+        self.cache.delete_queued_events(force=True)
+        logger.info("Drained {} cached events in {:.3f}s".format(sent, time.time() - start))
+        self.assertEqual(sent, self.events_count)
+        self.assertEqual(self.cache.get_from_query("SELECT COUNT(*) FROM `event`;")[0][0], 0)
+
+    def test_has_events(self):
+        self.assertFalse(self.cache.has_events())
+        self.cache.add_event("event")
+        self.assertTrue(self.cache.has_events())
+        # the events being sent are still in the cache
+        self.assertEqual(len(self.cache.get_queued_events()), 1)
+        self.assertTrue(self.cache.has_events())
+        self.cache.delete_queued_events(force=True)
+        self.assertFalse(self.cache.has_events())
+
+
+class GeonodeLogstashTimeWindowsTest(SimpleTestCase):
+    """
+    Test the incremental dispatch time windows.
+    """
+
+    def _get_windows(self, last_successful_deliver=None, last_queued_deliver=None):
+        ld = LogstashDispatcher.__new__(LogstashDispatcher)
+        ld._centralized_server = SimpleNamespace(
+            interval=3600,
+            last_successful_deliver=last_successful_deliver,
+            last_queued_deliver=last_queued_deliver
+        )
+        return ld._get_time_windows()
+
+    def test_first_dispatch(self):
+        windows = self._get_windows()
+        self.assertEqual(len(windows), 1)
+        self.assertEqual(windows[0][1] - windows[0][0], datetime.timedelta(seconds=3600))
+
+    @override_settings(MONITORING_DATA_TTL=datetime.timedelta(days=7))
+    def test_backfill(self):
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        watermark = now - datetime.timedelta(hours=5, minutes=30)
+        windows = self._get_windows(last_successful_deliver=watermark)
+        self.assertEqual(len(windows), 5)
+        self.assertEqual(windows[0][0], watermark)
+        for (_from, _to), (next_from, _next_to) in zip(windows, windows[1:]):
+            self.assertEqual(_to, next_from)
+        # Windows queued but not delivered yet are not aggregated again
+        windows = self._get_windows(
+            last_successful_deliver=watermark,
+            last_queued_deliver=watermark + datetime.timedelta(hours=3)
+        )
+        self.assertEqual(len(windows), 2)
+        # Overlapping run
+        self.assertEqual(self._get_windows(last_successful_deliver=now), [])
+
+    @override_settings(MONITORING_DATA_TTL=datetime.timedelta(days=1))
+    def test_backfill_data_ttl(self):
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        windows = self._get_windows(last_successful_deliver=now - datetime.timedelta(days=30))
+        self.assertEqual(len(windows), 24)
+
+    @override_settings(MONITORING_DATA_TTL=datetime.timedelta(days=7))
+    def test_failed_window(self):
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        watermark = now - datetime.timedelta(hours=3, minutes=30)
+        ld = LogstashDispatcher.__new__(LogstashDispatcher)
+        ld._centralized_server = FakeCentralizedServer(
+            interval=3600, last_successful_deliver=watermark, last_queued_deliver=None,
+            next_scheduled_deliver=None
+        )
+        windows = ld._get_time_windows()
+        enqueued = []
+        ld._enqueue_messages = lambda messages: enqueued.extend(messages) or len(messages)
+        ld._wait_for_delivery = lambda messages_count: None
+        ld._update_server = lambda: enqueued.append(("update", ld._valid_to))
+        # One data type of the second window fails
+        results = [(["w1"], 0), (["w2"], 1), (["w3"], 0)]
+        ld._get_window_messages = lambda: results.pop(0)
+        ld._dispatch_windows()
+        self.assertEqual(ld._centralized_server.last_queued_deliver, windows[0][1])
+        self.assertEqual(enqueued, ["w1", "w2", ("update", windows[0][1])])
+        # The failed window is retried on next run
+        self.assertEqual(ld._get_time_windows()[0], windows[1])
+
+
+class GeonodeLogstashConcurrentDispatchTest(SimpleTestCase):
+    """
+    Test the concurrent collection of the messages and the wait for the worker queue.
+    """
+
+    def setUp(self):
+        self.ld = LogstashDispatcher.__new__(LogstashDispatcher)
+        self.ld._get_message = self._get_message
+        concurrent_dispatch = logstash.CONCURRENT_DISPATCH
+        self.addCleanup(setattr, logstash, "CONCURRENT_DISPATCH", concurrent_dispatch)
+
+    @staticmethod
+    def _get_message(data_type):
+        if data_type["name"] == "countries":
+            raise ValueError("Metric not found")
+        if data_type["name"] == "resources":
+            return None
+        # The slowest data types come first
+        time.sleep(0.01 * (len(DATA_TYPES_MAP) - DATA_TYPES_MAP.index(data_type)))
+        return {"format_version": "1.0", "data_type": data_type["name"]}
+
+    def test_collect_messages(self):
+        logstash.CONCURRENT_DISPATCH = False
+        sequential = self.ld._get_window_messages()
+        logstash.CONCURRENT_DISPATCH = True
+        concurrent = self.ld._get_window_messages()
+        # Same messages in the same order, and the same failures
+        self.assertEqual(concurrent, sequential)
+        self.assertEqual(concurrent[1], 1)
+        self.assertEqual(
+            [msg["data_type"] for msg in concurrent[0]],
+            [dt["name"] for dt in DATA_TYPES_MAP if dt["name"] not in ("countries", "resources")]
+        )
+
+    def test_wait_for_queue_drain(self):
+        framing = CentralizedServer.FRAMING_LENGTH
+        sink = LogstashTcpSink(framing)
+        self.addCleanup(sink.close)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        handler = GeonodeAsynchronousLogstashHandler(
+            sink.host, sink.port, database_path=os.path.join(tmp_dir.name, "logstash.db"),
+            transport=partial(GeonodeTcpTransport, framing=framing)
+        )
+        self.addCleanup(handler.close)
+        events_count = 10
+        for i in range(events_count):
+            handler.emit(logging.makeLogRecord({"msg": {"format_version": "1.0", "event": i}}))
+        timeout = 30
+        start = time.time()
+        self.assertTrue(handler.wait_for_queue_drain(timeout))
+        # The wait ends as soon as the worker has sent the events, not at the timeout
+        self.assertLess(time.time() - start, timeout / 2)
+        self.assertEqual(sink.wait_for_events(events_count), events_count)
+        self.assertTrue(handler._worker_thread.is_queue_drained())
+
+
+class LogstashDispatcherConfigTest(SimpleTestCase):
+    """
+    Test the cached CentralizedServer configuration.
+    """
+
+    def setUp(self):
+        self.queries = 0
+        self.cs = CentralizedServer(host="localhost", port=5000, socket_timeout=1.5, logstash_db_timeout=None)
+        self._get_centralized_server = LogstashDispatcher._get_centralized_server
+        LogstashDispatcher._get_centralized_server = staticmethod(self._get_cs)
+        LogstashDispatcher.invalidate_config()
+
+    def tearDown(self):
+        LogstashDispatcher._get_centralized_server = staticmethod(self._get_centralized_server)
+        LogstashDispatcher.invalidate_config()
+
+    def _get_cs(self):
+        self.queries += 1
+        return self.cs
+
+    def test_cached_config(self):
+        for _i in range(10):
+            self.assertEqual(LogstashDispatcher.get_socket_timeout(), 1.5)
+            self.assertEqual(LogstashDispatcher.get_logstash_db_timeout(), CONSTANTS_DEFAULTS["DATABASE_TIMEOUT"])
+        self.assertEqual(self.queries, 1)
+        # Delivery timestamps do not invalidate the cache
+        signals.post_save.send(
+            sender=CentralizedServer, instance=self.cs, created=False, update_fields=["last_queued_deliver"]
+        )
+        LogstashDispatcher.get_socket_timeout()
+        self.assertEqual(self.queries, 1)
+        self.cs.socket_timeout = 3.0
+        signals.post_save.send(sender=CentralizedServer, instance=self.cs, created=False, update_fields=None)
+        self.assertEqual(LogstashDispatcher.get_socket_timeout(), 3.0)
+        self.assertEqual(self.queries, 2)
+
+    def test_apply_config(self):
+        defaults = {name: getattr(constants, name) for name in CONSTANTS_DEFAULTS}
+        try:
+            LogstashDispatcher._apply_config(LogstashDispatcher._set_config(self.cs))
+            self.assertEqual(constants.SOCKET_TIMEOUT, 1.5)
+            self.assertEqual(constants.DATABASE_TIMEOUT, CONSTANTS_DEFAULTS["DATABASE_TIMEOUT"])
+            self.assertEqual(self.queries, 0)
+        finally:
+            LogstashDispatcher._apply_config(defaults)
+
+
+STARTUP_SCRIPT = """
+import django
+from django.db import connection
+
+queries = []
+
+
+def log_query(execute, sql, params, many, context):
+    queries.append(sql)
+    return execute(sql, params, many, context)
+
+
+with connection.execute_wrapper(log_query):
+    django.setup()
+print(len([sql for sql in queries if "geonode_logstash" in sql]))
+"""
+
+
+class GeonodeLogstashStartupTest(SimpleTestCase):
+    """
+    Benchmark of the cost added by the app to django.setup() (measured on a new interpreter).
+    """
+
+    # Maximum import time of the app modules, their dependencies excluded (in microseconds)
+    MAX_IMPORT_TIME = 200000
+    LAZY_MODULES = ("geonode_logstash.logstash", "logstash_async", "pycountry")
+
+    def test_startup(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True
+        )
+        # No queries on the app tables
+        self.assertEqual(result.stdout.strip().splitlines()[-1], "0")
+        import_times = {}
+        for line in result.stderr.splitlines():
+            # "import time: self [us] | cumulative | imported package"
+            if line.startswith("import time:") and "|" in line:
+                self_time, _cumulative, module = line[len("import time:"):].split("|")
+                if self_time.strip().isdigit():
+                    import_times[module.strip()] = int(self_time)
+        for module in self.LAZY_MODULES:
+            self.assertNotIn(module, import_times)
+        app_import_time = sum(
+            import_time for module, import_time in import_times.items()
+            if module.split(".")[0] == "geonode_logstash"
+        )
+        logger.info("geonode_logstash import time: {} us".format(app_import_time))
+        self.assertLess(app_import_time, self.MAX_IMPORT_TIME)
@@ -29,5 +29,10 @@ setup(
     install_requires=[
         'six>=1.15.0',
         'python-logstash-async>=1.5.1,<2.0.0'
-    ]
+    ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'orjson': ['orjson'],
+        'ujson': ['ujson']
+    }
 )
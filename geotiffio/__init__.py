@@ -1,26 +1,200 @@
+import math
 from urllib import quote
+from urllib import quote_plus
 from urllib import urlencode
 
 from django.conf import settings
+from django.urls import reverse
 
+# the import connects the export and the removal of the cached COGs of the saved and deleted layers
+from .cog import get_cached_cog, get_cached_cogs, get_cog_filename
 
-def create_geotiff_io_url(layer, access_token):
 
-    # check if layer is a raster
-    if layer.storeType == 'coverageStore':
+# Encoded URL prefix by (GEOTIFF_IO_BASE_URL, GEOSERVER_PUBLIC_LOCATION, format)
+_url_prefixes = {}
+
+# Media type of the Cloud-Optimized GeoTIFFs produced by the GeoServer WCS
+COG_FORMAT = "image/tiff;application=geotiff;profile=cloud-optimized"
+
+# CRS of the WCS 2.0.1 subsets (the layers lat-lon bbox)
+SUBSETTING_CRS = "http://www.opengis.net/def/crs/EPSG/0/4326"
+
+# Grid axes of the WCS 2.0.1 scaling extension
+SCALE_AXES = ("http://www.opengis.net/def/axis/OGC/1/i", "http://www.opengis.net/def/axis/OGC/1/j")
+
 
+def _get_url_prefix(cog=False):
+    """
+    Return the constant part of the GeoTIFF.io URLs, up to the coverageid value.
+    """
+    output_format = getattr(settings, 'GEOTIFF_IO_COG_FORMAT', COG_FORMAT) if cog else "image/tiff"
+    key = (settings.GEOTIFF_IO_BASE_URL, settings.GEOSERVER_PUBLIC_LOCATION, output_format)
+    prefix = _url_prefixes.get(key)
+    if prefix is None:
         params = [
             ("service", "WCS"),
-            ("format", "image/tiff"),
+            ("format", output_format),
             ("request", "GetCoverage"),
             ("srs", "EPSG:4326"),
             ("version", "2.0.1"),
-            ("coverageid", "geonode:" + layer.name)
         ]
+        url_to_geotiff = settings.GEOSERVER_PUBLIC_LOCATION + "wcs?" + urlencode(params) + "&coverageid="
+        # quote works character by character: the URL can be quoted in pieces
+        prefix = _url_prefixes[key] = settings.GEOTIFF_IO_BASE_URL + "?url=" + quote(url_to_geotiff)
+    return prefix
+
+
+def _get_url_suffix(access_token):
+    if access_token:
+        return quote("&" + urlencode([("access_token", access_token)]))
+    return ""
+
+
+def _get_coverage_id(store_type, name):
+    """
+    Return the encoded coverageid of a raster layer (None for the other layers).
+    """
+    # check if layer is a raster
+    if store_type == 'coverageStore':
+        return quote(quote_plus("geonode:" + name))
+    return None
+
+
+def get_output_size(width, height, max_pixels):
+    """
+    Return the size (in pixels) of an extent resampled to a target number of pixels, keeping its
+    aspect ratio (the extent is upsampled when its native grid is smaller).
+    :param width: width of the extent
+    :param height: height of the extent
+    :param max_pixels: target number of pixels
+    :return: (columns, rows) tuple
+    """
+    aspect = float(width) / float(height)
+    return (
+        max(1, int(math.sqrt(max_pixels * aspect))),
+        max(1, int(math.sqrt(max_pixels / aspect)))
+    )
+
+
+def _get_subset_params(ll_bbox, extent=None, max_pixels=None, scale_factor=None):
+    """
+    Return the WCS 2.0.1 subsetting and scaling parameters of a request.
+    :param ll_bbox: lat-lon bbox of the layer, [x0, x1, y0, y1]
+    :param extent: optional subset, (minx, miny, maxx, maxy) in EPSG:4326
+    :param max_pixels: optional target size (number of pixels) of the output, it is requested as
+                       scalesize whatever the native grid of the layer
+    :param scale_factor: optional scale factor (it takes precedence over max_pixels)
+    :return: list of parameters
+    """
+    if any(coord is None for coord in ll_bbox[0:4]):
+        return []
+    x0, x1, y0, y1 = [float(coord) for coord in ll_bbox[0:4]]
+    params = []
+    if extent:
+        x0, y0, x1, y1 = max(x0, extent[0]), max(y0, extent[1]), min(x1, extent[2]), min(y1, extent[3])
+        if x0 >= x1 or y0 >= y1:
+            raise ValueError("The extent does not intersect the layer")
+        params += [
+            ("subset", "Long(%s,%s)" % (x0, x1)),
+            ("subset", "Lat(%s,%s)" % (y0, y1)),
+            ("subsettingcrs", SUBSETTING_CRS),
+        ]
+    if scale_factor:
+        params.append(("scalefactor", scale_factor))
+    elif max_pixels and x1 > x0 and y1 > y0:
+        columns, rows = get_output_size(x1 - x0, y1 - y0, max_pixels)
+        params.append(("scalesize", "%s(%d),%s(%d)" % (SCALE_AXES[0], columns, SCALE_AXES[1], rows)))
+    return params
+
+
+def _create_cached_cog_url(layer, access_token, cached_cogs=None):
+    """
+    Return the GeoTIFF.io link of the cached COG of a raster layer, None when the layer version
+    has not been exported yet (the exports are queued when the layers are saved).
+    :param cached_cogs: optional names of the cached COGs (the cache directory is checked otherwise)
+    """
+    filename = get_cog_filename(layer)
+    if cached_cogs is None:
+        if get_cached_cog(layer) is None:
+            return None
+    elif filename not in cached_cogs:
+        return None
+    url_to_geotiff = settings.SITEURL.rstrip('/') + reverse('geotiffio_cog', args=[filename])
+    if access_token:
+        url_to_geotiff += "?" + urlencode([("access_token", access_token)])
+    return settings.GEOTIFF_IO_BASE_URL + "?url=" + quote(url_to_geotiff)
+
+
+def create_geotiff_io_url(layer, access_token, extent=None, max_pixels=None, scale_factor=None, cog=None):
+    """
+    Create the GeoTIFF.io link of a raster layer (None for the other layers).
+    :param layer: layer
+    :param access_token: access token appended to the WCS URL (if any)
+    :param extent: optional subset, (minx, miny, maxx, maxy) in EPSG:4326
+    :param max_pixels: target size of the output, in pixels (GEOTIFF_IO_MAX_PIXELS by default)
+    :param scale_factor: optional scale factor, to fetch an overview
+    :param cog: whether to request a Cloud-Optimized GeoTIFF (GEOTIFF_IO_COG by default)
+    :return: link (to the cached COG, if any, when neither extent nor scale_factor are given)
+    """
+    if max_pixels is None:
+        max_pixels = getattr(settings, 'GEOTIFF_IO_MAX_PIXELS', None)
+    if cog is None:
+        cog = getattr(settings, 'GEOTIFF_IO_COG', False)
+    return _create_layer_url(layer, access_token, extent, max_pixels, scale_factor, cog)
+
 
-        if access_token:
-            params.append(("access_token", access_token))
+def _create_layer_url(layer, access_token, extent, max_pixels, scale_factor, cog, cached_cogs=None):
+    coverage_id = _get_coverage_id(layer.storeType, layer.name)
+    if coverage_id is None:
+        return None
+    if getattr(settings, 'GEOTIFF_IO_CACHE_DIR', None) and not extent and not scale_factor:
+        url = _create_cached_cog_url(layer, access_token, cached_cogs)
+        if url is not None:
+            return url
+    subset = ""
+    if extent or max_pixels or scale_factor:
+        params = _get_subset_params(layer.ll_bbox, extent, max_pixels, scale_factor)
+        if params:
+            subset = quote("&" + urlencode(params))
+    return _get_url_prefix(cog) + coverage_id + subset + _get_url_suffix(access_token)
 
-        url_to_geotiff = settings.GEOSERVER_PUBLIC_LOCATION + "wcs?" + urlencode(params)
 
-        return settings.GEOTIFF_IO_BASE_URL + "?url=" + quote(url_to_geotiff)
+def create_geotiff_io_urls(layers, access_token, max_pixels=None, cog=None):
+    """
+    Create the GeoTIFF.io URLs of several layers in one pass.
+    :param layers: queryset (only id and name of the rasters are fetched) or list of layers
+    :param access_token: access token appended to the WCS URLs (if any)
+    :param max_pixels: target size of the outputs, in pixels (GEOTIFF_IO_MAX_PIXELS by default)
+    :param cog: whether to request Cloud-Optimized GeoTIFFs (GEOTIFF_IO_COG by default)
+    :return: dict of the URLs by layer id, for the raster layers
+    """
+    if max_pixels is None:
+        max_pixels = getattr(settings, 'GEOTIFF_IO_MAX_PIXELS', None)
+    if cog is None:
+        cog = getattr(settings, 'GEOTIFF_IO_COG', False)
+    if max_pixels or getattr(settings, 'GEOTIFF_IO_CACHE_DIR', None):
+        # the links depend on the bbox and on the version of each layer
+        if hasattr(layers, 'values_list'):
+            layers = layers.filter(storeType='coverageStore').only(
+                'id', 'storeType', 'name', 'uuid', 'last_updated',
+                'bbox_x0', 'bbox_x1', 'bbox_y0', 'bbox_y1', 'srid')
+        # the cache directory is listed once, not checked for each layer
+        cached_cogs = get_cached_cogs()
+        urls = {}
+        for layer in layers:
+            url = _create_layer_url(layer, access_token, None, max_pixels, None, cog, cached_cogs)
+            if url is not None:
+                urls[layer.pk] = url
+        return urls
+    if hasattr(layers, 'values_list'):
+        rows = layers.filter(storeType='coverageStore').values_list('id', 'storeType', 'name')
+    else:
+        rows = [(layer.pk, layer.storeType, layer.name) for layer in layers]
+    prefix = _get_url_prefix(cog)
+    suffix = _get_url_suffix(access_token)
+    urls = {}
+    for layer_id, store_type, name in rows:
+        coverage_id = _get_coverage_id(store_type, name)
+        if coverage_id is not None:
+            urls[layer_id] = prefix + coverage_id + suffix
+    return urls
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2016 OSGeo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import os
+import re
+import calendar
+import logging
+import tempfile
+from urllib import urlencode
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import signals
+
+logger = logging.getLogger(__name__)
+
+# Cached COGs are named after the layer uuid and the last-modified time of the layer
+COG_FILENAME_RE = re.compile(r'^(?P<uuid>[0-9a-f-]{36})-(?P<version>[0-9]+)\.tif$')
+
+# Seconds before a failed export can be requested again
+EXPORT_REQUEST_TIMEOUT = 3600
+
+
+def get_cache_dir():
+    """
+    Return the directory of the COG export cache (None when the cache is disabled).
+    """
+    return getattr(settings, 'GEOTIFF_IO_CACHE_DIR', None)
+
+
+def get_cache_quota():
+    """
+    Return the disk quota of the COG export cache, in bytes.
+    """
+    return getattr(settings, 'GEOTIFF_IO_CACHE_QUOTA', 10 * 1024 ** 3)
+
+
+def get_cog_filename(layer):
+    """
+    Return the name of the cached COG of a layer version.
+    """
+    version = 0
+    if layer.last_updated:
+        version = calendar.timegm(layer.last_updated.utctimetuple())
+    return "%s-%d.tif" % (layer.uuid, version)
+
+
+def get_cached_cog(layer):
+    """
+    Return the path of the cached COG of a layer, None when it has not been exported yet.
+    """
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return None
+    path = os.path.join(cache_dir, get_cog_filename(layer))
+    if os.path.exists(path):
+        return path
+
+
+def get_cached_cogs():
+    """
+    Return the names of the cached COGs, listing the cache directory once.
+    """
+    cache_dir = get_cache_dir()
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return set()
+    return set(filename for filename in os.listdir(cache_dir) if COG_FILENAME_RE.match(filename))
+
+
+def request_cog_export(layer):
+    """
+    Queue the export of a layer version (once, for all the processes sharing the Django cache).
+    """
+    if cache.add('geotiffio:export:%s' % get_cog_filename(layer), True, EXPORT_REQUEST_TIMEOUT):
+        from .tasks import export_cog
+        try:
+            export_cog.delay(layer.pk)
+        except Exception as e:
+            logger.error("Error queuing the COG export of layer %s: %s" % (layer.name, str(e)))
+
+
+def export_cog(layer):
+    """
+    Export a layer version as a Cloud-Optimized GeoTIFF (GeoServer WCS), then evict the least
+    recently used COGs above the quota. A COG larger than the quota is not cached.
+    :return: path of the cached COG (None when it is larger than the quota)
+    """
+    from . import COG_FORMAT
+    cache_dir = get_cache_dir()
+    filename = get_cog_filename(layer)
+    path = os.path.join(cache_dir, filename)
+    if os.path.exists(path):
+        return path
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    ogc_server = settings.OGC_SERVER['default']
+    params = [
+        ("service", "WCS"),
+        ("format", getattr(settings, 'GEOTIFF_IO_COG_FORMAT', COG_FORMAT)),
+        ("request", "GetCoverage"),
+        ("version", "2.0.1"),
+        ("coverageid", "geonode:" + layer.name)
+    ]
+    quota = get_cache_quota()
+    size = 0
+    # the partial file is not seen by the other processes, rename is atomic
+    fd, part_path = tempfile.mkstemp(suffix='.part', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as part:
+            response = requests.get(
+                ogc_server['LOCATION'] + "wcs?" + urlencode(params),
+                auth=(ogc_server['USER'], ogc_server['PASSWORD']),
+                stream=True,
+                timeout=getattr(settings, 'GEOTIFF_IO_EXPORT_TIMEOUT', 600))
+            try:
+                response.raise_for_status()
+                if not response.headers.get('Content-Type', '').startswith('image/tiff'):
+                    raise ValueError("Unexpected WCS response: %s" % response.headers.get('Content-Type'))
+                for chunk in response.iter_content(1024 * 1024):
+                    size += len(chunk)
+                    if size > quota:
+                        break
+                    part.write(chunk)
+            finally:
+                response.close()
+        if size > quota:
+            os.remove(part_path)
+            logger.warning(
+                "The COG of layer %s is larger than GEOTIFF_IO_CACHE_QUOTA (%d bytes), it is not cached" % (
+                    layer.name, quota))
+            return None
+        os.rename(part_path, path)
+    except Exception:
+        os.remove(part_path)
+        raise
+    remove_cached_cogs(layer.uuid, keep=filename)
+    # the COG just exported is kept, even if it is the least recently served one
+    evict(keep=path)
+    return path
+
+
+def remove_cached_cogs(uuid, keep=None):
+    """
+    Remove the cached COGs of a layer (the older versions when keep is given).
+    """
+    cache_dir = get_cache_dir()
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return
+    for filename in os.listdir(cache_dir):
+        if filename.startswith(uuid + '-') and filename != keep:
+            try:
+                os.remove(os.path.join(cache_dir, filename))
+            except OSError:
+                pass
+
+
+def evict(quota=None, keep=None):
+    """
+    Remove the least recently served COGs until the cache is under the quota
+    (GEOTIFF_IO_CACHE_QUOTA bytes, 10 GB by default).
+    :param keep: path of a COG which is not removed (it is counted in the cache size)
+    """
+    cache_dir = get_cache_dir()
+    if quota is None:
+        quota = get_cache_quota()
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if not COG_FILENAME_RE.match(filename):
+            continue
+        path = os.path.join(cache_dir, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        # the modification time is updated when the COG is served
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= quota:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        logger.debug("Evicted COG %s" % path)
+        total -= size
+
+
+def remove_layer_cogs(instance, **kwargs):
+    """
+    Remove the cached COGs of a deleted layer.
+    """
+    remove_cached_cogs(instance.uuid)
+
+
+def queue_layer_cog_export(instance, **kwargs):
+    """
+    Queue the export of a published or updated raster layer, once the layer is committed.
+    """
+    if kwargs.get('raw') or not get_cache_dir() or instance.storeType != 'coverageStore':
+        return
+    transaction.on_commit(lambda: request_cog_export(instance))
+
+
+signals.post_save.connect(queue_layer_cog_export, sender='layers.Layer')
+signals.post_delete.connect(remove_layer_cogs, sender='layers.Layer')
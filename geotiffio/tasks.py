@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2016 OSGeo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+from celery import shared_task
+
+
+@shared_task
+def export_cog(layer_id):
+    """
+    Export a layer as a Cloud-Optimized GeoTIFF in the local cache
+    """
+    from geonode.layers.models import Layer
+    from .cog import export_cog as export_layer_cog
+    layer = Layer.objects.filter(pk=layer_id).first()
+    if layer is not None:
+        export_layer_cog(layer)
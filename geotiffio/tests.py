@@ -28,7 +28,10 @@ import datetime
 import urllib2
 # import base64
 import time
+import shutil
+import tempfile
 import logging
+import mock
 
 from StringIO import StringIO
 # import traceback
@@ -38,8 +41,10 @@ from lxml import etree
 from urlparse import urljoin
 
 from django.conf import settings
+from django.test import RequestFactory, SimpleTestCase
 from django.test.utils import override_settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.http import Http404
 from django.core.management import call_command
 from django.urls import reverse
 from django.contrib.staticfiles.templatetags import staticfiles
@@ -54,6 +59,8 @@ from geoserver.catalog import FailedRequestError
 
 # from geonode.security.models import *
 from geonode.contrib import geotiffio
+from geonode.contrib.geotiffio.cog import evict, get_cog_filename, queue_layer_cog_export
+from geonode.contrib.geotiffio.views import cog, parse_range
 from geonode.decorators import on_ogc_backend
 from geonode.base.models import TopicCategory, Link
 from geonode.layers.models import Layer
@@ -162,3 +169,236 @@ class GeoTIFFIOTest(GeoNodeLiveTestSupport):
 
         # Clean up and completely delete the layer
         uploaded.delete()
+
+
+@override_settings(
+    GEOTIFF_IO_BASE_URL="http://app.geotiff.io",
+    GEOSERVER_PUBLIC_LOCATION="http://localhost:8080/geoserver/")
+class GeoTIFFIOBatchTest(SimpleTestCase):
+    """
+    Tests the batch creation of the geotiff.io links
+    """
+
+    def testBatchUrls(self):
+        raster = Layer(id=1, name='test_grid', storeType='coverageStore')
+        vector = Layer(id=2, name='san_andres_y_providencia_poi', storeType='dataStore')
+        access_token = "8FYB137y87sdfb8b1l8ybf7dsbf"
+
+        urls = geotiffio.create_geotiff_io_urls([raster, vector], access_token)
+        self.assertEqual(urls, {1: geotiffio.create_geotiff_io_url(raster, access_token)})
+        self.assertEqual(
+            urls[1],
+            'http://app.geotiff.io?url='
+            'http%3A//localhost%3A8080/geoserver/wcs%3F'
+            'service%3DWCS'
+            '%26format%3Dimage%252Ftiff'
+            '%26request%3DGetCoverage'
+            '%26srs%3DEPSG%253A4326'
+            '%26version%3D2.0.1'
+            '%26coverageid%3Dgeonode%253Atest_grid'
+            '%26access_token%3D8FYB137y87sdfb8b1l8ybf7dsbf')
+        self.assertEqual(geotiffio.create_geotiff_io_url(vector, None), None)
+
+    def testRenamedLayer(self):
+        raster = Layer(id=1, name='test_grid', storeType='coverageStore')
+        geotiffio.create_geotiff_io_url(raster, None)
+        raster.name = 'test_grid_renamed'
+        self.assertTrue(
+            geotiffio.create_geotiff_io_url(raster, None).endswith('coverageid%3Dgeonode%253Atest_grid_renamed'))
+
+
+class GeoTIFFIOSubsetTest(SimpleTestCase):
+    """
+    Tests the WCS 2.0.1 subsetting and scaling parameters of the geotiff.io links
+    """
+
+    def testOutputSize(self):
+        self.assertEqual(geotiffio.get_output_size(20, 5, 1000000), (2000, 500))
+        self.assertEqual(geotiffio.get_output_size(1, 1000000, 100), (1, 10000))
+
+    def testSubsetParams(self):
+        ll_bbox = [-10, 10, 0, 5, 'EPSG:4326']
+        params = geotiffio._get_subset_params(ll_bbox, extent=(0, 1, 20, 20), max_pixels=1000)
+        self.assertEqual(params[0:3], [
+            ("subset", "Long(0.0,10.0)"),
+            ("subset", "Lat(1.0,5.0)"),
+            ("subsettingcrs", "http://www.opengis.net/def/crs/EPSG/0/4326"),
+        ])
+        self.assertEqual(params[3], (
+            "scalesize", "http://www.opengis.net/def/axis/OGC/1/i(50),http://www.opengis.net/def/axis/OGC/1/j(20)"
+        ))
+        # the scale factor takes precedence over the target size
+        self.assertEqual(
+            geotiffio._get_subset_params(ll_bbox, max_pixels=1000, scale_factor=0.25), [("scalefactor", 0.25)]
+        )
+        self.assertEqual(geotiffio._get_subset_params([None, None, None, None, None], max_pixels=1000), [])
+        with self.assertRaises(ValueError):
+            geotiffio._get_subset_params(ll_bbox, extent=(20, 20, 30, 30))
+
+
+class GeoTIFFIOCogCacheTest(SimpleTestCase):
+    """
+    Tests the local COG export cache
+    """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def testCogFilename(self):
+        layer = Layer(
+            uuid='9d4fa4ee-6b0a-11e9-8b6a-0242ac120005',
+            last_updated=datetime.datetime(2019, 5, 1, 12, 0, 0))
+        self.assertEqual(get_cog_filename(layer), '9d4fa4ee-6b0a-11e9-8b6a-0242ac120005-1556712000.tif')
+
+    @mock.patch('geonode.contrib.geotiffio.cog.request_cog_export')
+    def testExportOnSave(self, mock_export):
+        raster = Layer(id=1, name='test_grid', storeType='coverageStore')
+        vector = Layer(id=2, name='san_andres_y_providencia_poi', storeType='dataStore')
+        with mock.patch('geonode.contrib.geotiffio.cog.transaction.on_commit', side_effect=lambda func: func()):
+            queue_layer_cog_export(raster, created=True)
+            self.assertEqual(mock_export.call_count, 0)
+            with self.settings(GEOTIFF_IO_CACHE_DIR=self.cache_dir):
+                queue_layer_cog_export(vector, created=True)
+                queue_layer_cog_export(raster, created=True, raw=True)
+                self.assertEqual(mock_export.call_count, 0)
+                queue_layer_cog_export(raster, created=False)
+        mock_export.assert_called_once_with(raster)
+
+    @override_settings(
+        ROOT_URLCONF='geonode.contrib.geotiffio.urls',
+        SITEURL='http://localhost:8000/',
+        GEOTIFF_IO_BASE_URL="http://app.geotiff.io",
+        GEOSERVER_PUBLIC_LOCATION="http://localhost:8080/geoserver/")
+    @mock.patch('geonode.contrib.geotiffio.cog.request_cog_export')
+    def testCachedLinks(self, mock_export):
+        cached = Layer(
+            id=1, name='test_grid', storeType='coverageStore',
+            uuid='9d4fa4ee-6b0a-11e9-8b6a-0242ac120005', last_updated=datetime.datetime(2019, 5, 1, 12, 0, 0))
+        exporting = Layer(
+            id=2, name='test_grid_2', storeType='coverageStore',
+            uuid='9d4fa4ee-6b0a-11e9-8b6a-0242ac120006', last_updated=datetime.datetime(2019, 5, 1, 12, 0, 0))
+        with open(os.path.join(self.cache_dir, get_cog_filename(cached)), 'wb') as cog_file:
+            cog_file.write(b'x' * 100)
+        with self.settings(GEOTIFF_IO_CACHE_DIR=self.cache_dir):
+            # the cache directory is listed once
+            with mock.patch('geonode.contrib.geotiffio.cog.os.path.exists', side_effect=AssertionError):
+                urls = geotiffio.create_geotiff_io_urls([cached, exporting], None)
+            self.assertEqual(urls, {
+                1: geotiffio.create_geotiff_io_url(cached, None),
+                2: geotiffio.create_geotiff_io_url(exporting, None),
+            })
+        self.assertEqual(
+            urls[1],
+            'http://app.geotiff.io?url='
+            'http%3A//localhost%3A8000/cog/9d4fa4ee-6b0a-11e9-8b6a-0242ac120005-1556712000.tif')
+        self.assertTrue(urls[2].endswith('coverageid%3Dgeonode%253Atest_grid_2'))
+        # the links do not queue the exports
+        self.assertEqual(mock_export.call_count, 0)
+
+    def testEviction(self):
+        paths = []
+        for version in range(4):
+            path = os.path.join(self.cache_dir, '9d4fa4ee-6b0a-11e9-8b6a-0242ac12000%d-%d.tif' % (version, version))
+            with open(path, 'wb') as cog:
+                cog.write(b'x' * 100)
+            # the least recently served COGs are evicted first
+            os.utime(path, (1000 + version, 1000 + version))
+            paths.append(path)
+        with self.settings(GEOTIFF_IO_CACHE_DIR=self.cache_dir):
+            evict(quota=250)
+        self.assertEqual([os.path.exists(path) for path in paths], [False, False, True, True])
+        with self.settings(GEOTIFF_IO_CACHE_DIR=self.cache_dir):
+            # the COG just exported is not evicted
+            evict(quota=50, keep=paths[2])
+        self.assertEqual([os.path.exists(path) for path in paths], [False, False, True, False])
+
+    def testRange(self):
+        self.assertEqual(parse_range(None, 100), None)
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=50-500', 100), (50, 99))
+        # multiple ranges: the whole file is served
+        self.assertEqual(parse_range('bytes=0-1,5-6', 100), None)
+        with self.assertRaises(ValueError):
+            parse_range('bytes=100-', 100)
+
+
+@override_settings(ROOT_URLCONF='geonode.contrib.geotiffio.urls')
+class GeoTIFFIOCogViewTest(SimpleTestCase):
+    """
+    Tests the view serving the cached COGs
+    """
+
+    filename = '9d4fa4ee-6b0a-11e9-8b6a-0242ac120005-1556712000.tif'
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.cache_dir, self.filename), 'wb') as cog_file:
+            cog_file.write(b'0123456789' * 10)
+        self.layer = mock.Mock()
+        self.factory = RequestFactory()
+        patcher = mock.patch('geonode.contrib.geotiffio.views.get_object_or_404', return_value=self.layer)
+        self.mock_get_layer = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('geonode.contrib.geotiffio.views.get_token_user', return_value=None)
+        self.mock_token_user = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def get(self, method='get', user_perm=True, **extra):
+        request = getattr(self.factory, method)('/cog/%s' % self.filename, **extra)
+        request.user = mock.Mock()
+        request.user.has_perm.return_value = user_perm
+        with self.settings(GEOTIFF_IO_CACHE_DIR=self.cache_dir):
+            return cog(request, self.filename)
+
+    def testDownloadPermission(self):
+        response = self.get(user_perm=False)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(self.mock_get_layer.call_args[1], {'uuid': '9d4fa4ee-6b0a-11e9-8b6a-0242ac120005'})
+
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789' * 10)
+
+    def testAccessTokenUser(self):
+        token_user = mock.Mock()
+        token_user.has_perm.return_value = True
+        self.mock_token_user.return_value = token_user
+        # geotiff.io does not send the session cookie: the token user is checked
+        response = self.get(user_perm=False, data={'access_token': '8FYB137y87sdfb8b1l8ybf7dsbf'})
+        self.assertEqual(response.status_code, 200)
+        self.mock_token_user.assert_called_once_with('8FYB137y87sdfb8b1l8ybf7dsbf')
+        token_user.has_perm.assert_called_once_with('download_resourcebase', self.layer.get_self_resource())
+
+    def testRange(self):
+        response = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+        response = self.get(HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def testHead(self):
+        response = self.get(method='head', HTTP_RANGE='bytes=-10')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 90-99/100')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.content, b'')
+
+    def testMissingCog(self):
+        os.remove(os.path.join(self.cache_dir, self.filename))
+        with self.assertRaises(Http404):
+            self.get()
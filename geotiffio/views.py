@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2016 OSGeo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import os
+import re
+
+from django.http import Http404, HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_http_methods
+
+from .cog import COG_FILENAME_RE, get_cache_dir
+
+RANGE_RE = re.compile(r'^bytes=(?P<start>[0-9]*)-(?P<end>[0-9]*)$')
+
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range Range header.
+    :param header: value of the Range header
+    :param size: size of the file
+    :return: (start, end) inclusive, None to serve the whole file (missing or multiple ranges)
+    :raise ValueError: when the range can not be satisfied
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    start, end = match.group('start'), match.group('end')
+    if not start:
+        # suffix range: the last bytes of the file
+        if not end or not int(end):
+            raise ValueError("Unsatisfiable range")
+        return max(0, size - int(end)), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+
+def get_token_user(access_token):
+    """
+    Return the user of a valid OAuth2 access token (None otherwise).
+    """
+    if not access_token:
+        return None
+    from oauth2_provider.models import AccessToken
+    token = AccessToken.objects.select_related('user').filter(token=access_token).first()
+    if token is not None and token.is_valid():
+        return token.user
+
+
+def read_file(cog_file, start, length):
+    try:
+        cog_file.seek(start)
+        while length > 0:
+            data = cog_file.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        cog_file.close()
+
+
+def add_cors_headers(response):
+    response['Access-Control-Allow-Origin'] = '*'
+    response['Access-Control-Allow-Headers'] = 'Range'
+    response['Access-Control-Expose-Headers'] = 'Accept-Ranges, Content-Length, Content-Range'
+    return response
+
+
+@require_http_methods(["GET", "HEAD", "OPTIONS"])
+def cog(request, filename):
+    """
+    Serve a cached COG, with HTTP range support
+    """
+    if request.method == 'OPTIONS':
+        return add_cors_headers(HttpResponse())
+    match = COG_FILENAME_RE.match(filename)
+    cache_dir = get_cache_dir()
+    if match is None or not cache_dir:
+        raise Http404
+    from geonode.layers.models import Layer
+    layer = get_object_or_404(Layer, uuid=match.group('uuid'))
+    # geotiff.io does not send the cookies: the access token of the link identifies the user
+    user = get_token_user(request.GET.get('access_token')) or request.user
+    if not user.has_perm('download_resourcebase', layer.get_self_resource()):
+        return add_cors_headers(HttpResponseForbidden())
+    path = os.path.join(cache_dir, filename)
+    try:
+        cog_file = open(path, 'rb')
+    except IOError:
+        raise Http404
+    size = os.fstat(cog_file.fileno()).st_size
+    try:
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    except ValueError:
+        cog_file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return add_cors_headers(response)
+    # recently served COGs are evicted last
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    start, end = byte_range or (0, size - 1)
+    status = 200 if byte_range is None else 206
+    if request.method == 'HEAD':
+        cog_file.close()
+        response = HttpResponse(status=status, content_type='image/tiff')
+    else:
+        response = StreamingHttpResponse(
+            read_file(cog_file, start, end - start + 1), status=status, content_type='image/tiff')
+    if byte_range is not None:
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+    response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    return add_cors_headers(response)